@@ -1 +1,11 @@
-from django.apps import AppConfig
\ No newline at end of file
+from django.apps import AppConfig
+
+
+class BooksOperatorConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'books_operator'
+
+    def ready(self):
+        from . import signals
+        from .catalog_cache import check_catalog_backend
+        check_catalog_backend()
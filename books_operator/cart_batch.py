@@ -0,0 +1,53 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
+from .models import Cart
+
+
+# Apply many cart line changes of one customer in one transaction and a fixed number of queries:
+# quantities are upserted (INSERT ... ON CONFLICT (customer, book) DO UPDATE), increments insert
+# the missing lines empty and then add to all of them with one UPDATE, removals are one DELETE.
+# sets and increments map book id -> quantity, removals is a collection of book ids
+def apply_cart_batch(customer_id, sets=None, increments=None, removals=None):
+    sets, increments, removals = sets or {}, increments or {}, removals or ()
+
+    with transaction.atomic():
+        if removals:
+            Cart.objects.filter(customer_id=customer_id, book_id__in=removals).delete()
+
+        if sets:
+            Cart.objects.bulk_create(
+                [Cart(customer_id=customer_id, book_id=book_id, quantity=quantity) for book_id, quantity in sets.items()],
+                update_conflicts=True,
+                unique_fields=['customer', 'book'],
+                update_fields=['quantity'],
+            )
+
+        if increments:
+            Cart.objects.bulk_create(
+                [Cart(customer_id=customer_id, book_id=book_id, quantity=0) for book_id in increments],
+                ignore_conflicts=True,
+            )
+            Cart.objects.filter(customer_id=customer_id, book_id__in=increments).update(
+                quantity=F('quantity') + Case(
+                    *[When(book_id=book_id, then=Value(amount)) for book_id, amount in increments.items()],
+                    default=Value(0),
+                )
+            )
+
+
+# Add to one cart line without reading it first. The UPDATE is atomic, so concurrent adds
+# never lose an increment; a missing line is inserted in a savepoint, and if a concurrent
+# request inserted it first the unique (customer, book) constraint sends us back to the UPDATE.
+# Returns True when the line was created
+def increment_cart_line(customer_id, book_id, amount=1):
+    lines = Cart.objects.filter(customer_id=customer_id, book_id=book_id)
+    if lines.update(quantity=F('quantity') + amount):
+        return False
+
+    try:
+        with transaction.atomic():
+            Cart.objects.create(customer_id=customer_id, book_id=book_id, quantity=amount)
+        return True
+    except IntegrityError:
+        lines.update(quantity=F('quantity') + amount)
+        return False
@@ -0,0 +1,198 @@
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from .cart_batch import apply_cart_batch, increment_cart_line
+from .cart_totals import line_totals, with_line_totals
+from .models import Book, Cart
+
+
+LOCK_TIMEOUT = 5
+DIRTY_KEY = 'carts:dirty'
+
+
+class CartLockTimeout(Exception):
+    pass
+
+
+# Cart lines live in the Cart table, every change is written there at once
+class DatabaseCartStore:
+    holds_changes = False
+
+    def increment(self, customer_id, book_id, amount=1):
+        return increment_cart_line(customer_id, book_id, amount)
+
+    def clear(self, customer_id):
+        Cart.objects.filter(customer_id=customer_id).delete()
+
+    def get_line(self, customer, book):
+        return with_line_totals(Cart.objects.select_related('book', 'customer__user')).get(customer=customer, book=book)
+
+    def flush(self, customer_id):
+        pass
+
+    def flush_all(self):
+        return 0
+
+    def synced(self, customer_id):
+        return nullcontext()
+
+
+# Cart lines of each customer are kept in the cache as {book_id: quantity} and written back
+# to the Cart table later: by the flush_cart_store command, before any route that reads the
+# Cart table and at checkout. Entries never expire, the cache backend must not evict them
+# before they are flushed. Changes of one customer are serialized by a cache.add() lock
+class CacheCartStore:
+    holds_changes = True
+
+    def __init__(self):
+        self.cache = caches[settings.CART_CACHE_ALIAS]
+        self.check_backend()
+
+    # Refuse caches that would lose carts: process-local ones, where flush_cart_store and the
+    # other workers see nothing, and culling ones whose MAX_ENTRIES can drop unflushed carts
+    def check_backend(self):
+        if isinstance(self.cache, (LocMemCache, DummyCache)) and not settings.CART_CACHE_ALLOW_LOCAL:
+            raise ImproperlyConfigured(
+                "CART_STORAGE='cache' needs a cache shared by all processes, set CART_CACHE_BACKEND "
+                "(or CART_CACHE_ALLOW_LOCAL=1 for a single process)."
+            )
+        if isinstance(self.cache, (LocMemCache, FileBasedCache, DatabaseCache)) and self.cache._max_entries < settings.CART_CACHE_MAX_ENTRIES:
+            raise ImproperlyConfigured(f"The '{settings.CART_CACHE_ALIAS}' cache culls carts, set its MAX_ENTRIES to CART_CACHE_MAX_ENTRIES.")
+
+    @staticmethod
+    def key(customer_id):
+        return f'cart:{customer_id}'
+
+    @contextmanager
+    def lock(self, key, renew=False):
+        lock_key = f'{key}:lock'
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        # The lock expires by itself if its holder dies
+        while not self.cache.add(lock_key, token, LOCK_TIMEOUT):
+            if time.monotonic() > deadline:
+                raise CartLockTimeout(f'Could not lock {key}.')
+            time.sleep(0.005)
+        try:
+            if renew:
+                with self.renewed(lock_key, token):
+                    yield
+            else:
+                yield
+        finally:
+            # A lock that expired and was taken by someone else is not ours to release
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+    # Extend a lock held for longer than LOCK_TIMEOUT (synced routes) while its holder runs
+    @contextmanager
+    def renewed(self, lock_key, token):
+        stop = threading.Event()
+
+        def renew():
+            cache = caches[settings.CART_CACHE_ALIAS]
+            while not stop.wait(LOCK_TIMEOUT / 3):
+                if cache.get(lock_key) != token:
+                    return
+                cache.touch(lock_key, LOCK_TIMEOUT)
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def load(self, customer_id):
+        entry = self.cache.get(self.key(customer_id))
+        if entry is None:
+            lines = dict(Cart.objects.filter(customer_id=customer_id).values_list('book_id', 'quantity'))
+            entry = {'lines': lines, 'dirty': False}
+        return entry
+
+    def save(self, customer_id, entry):
+        if not entry['dirty']:
+            entry['dirty'] = True
+            self.update_dirty(lambda dirty: dirty | {customer_id})
+        self.cache.set(self.key(customer_id), entry, timeout=None)
+
+    # Ids of the customers with changes that are not in the Cart table yet
+    def update_dirty(self, change):
+        with self.lock(DIRTY_KEY):
+            self.cache.set(DIRTY_KEY, change(self.cache.get(DIRTY_KEY, set())), timeout=None)
+
+    def increment(self, customer_id, book_id, amount=1):
+        with self.lock(self.key(customer_id)):
+            entry = self.load(customer_id)
+            created = book_id not in entry['lines']
+            entry['lines'][book_id] = entry['lines'].get(book_id, 0) + amount
+            self.save(customer_id, entry)
+        return created
+
+    def clear(self, customer_id):
+        with self.lock(self.key(customer_id)):
+            entry = self.load(customer_id)
+            entry['lines'] = {}
+            self.save(customer_id, entry)
+
+    # Line for the response of a cache write, not saved to the Cart table yet. It carries
+    # the line totals of with_line_totals, so the response matches the database store
+    def get_line(self, customer, book):
+        quantity = self.load(customer.id)['lines'].get(book.id, 0)
+        line = Cart(customer=customer, book=book, quantity=quantity)
+        for name, value in line_totals(book.price, book.discount, quantity).items():
+            setattr(line, name, value)
+        return line
+
+    # Write the cached cart to the Cart table and drop it from the cache, the next
+    # change loads it back, so writes made meanwhile through the Cart table are not lost
+    def flush(self, customer_id):
+        with self.lock(self.key(customer_id)):
+            self.write_back(customer_id)
+
+    def write_back(self, customer_id):
+        entry = self.cache.get(self.key(customer_id))
+        if entry is not None and entry['dirty']:
+            # Lines of books deleted meanwhile are dropped
+            books = set(Book.objects.filter(id__in=entry['lines']).values_list('id', flat=True))
+            lines = {book_id: quantity for book_id, quantity in entry['lines'].items() if book_id in books}
+            with transaction.atomic():
+                Cart.objects.filter(customer_id=customer_id).exclude(book_id__in=lines).delete()
+                apply_cart_batch(customer_id, sets=lines)
+            self.update_dirty(lambda dirty: dirty - {customer_id})
+        self.cache.delete(self.key(customer_id))
+
+    def flush_all(self):
+        dirty = self.cache.get(DIRTY_KEY, set())
+        for customer_id in dirty:
+            self.flush(customer_id)
+        return len(dirty)
+
+    # The cart is flushed and stays locked while a route reads or writes the Cart table directly
+    # (checkout, cart line updates), so a cached add can't slip in between and overwrite the change
+    # when it is written back. The lock is renewed for as long as the route takes
+    @contextmanager
+    def synced(self, customer_id):
+        with self.lock(self.key(customer_id), renew=True):
+            self.write_back(customer_id)
+            yield
+
+
+CART_STORES = {
+    'database': DatabaseCartStore,
+    'cache': CacheCartStore,
+}
+
+
+def get_cart_store():
+    return CART_STORES[settings.CART_STORAGE]()
@@ -0,0 +1,59 @@
+from decimal import ROUND_HALF_UP, Decimal
+from django.db.models import F, Sum, Window, DecimalField
+from django.db.models.functions import Round
+
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+CENT = Decimal('0.01')
+
+
+# Per-line money columns computed by the database from the joined book row.
+# Book.discount is a percentage, the discount of a line is rounded to cents
+def with_line_totals(carts):
+    return carts.annotate(
+        line_subtotal=F('book__price') * F('quantity'),
+    ).annotate(
+        line_discount=Round(F('line_subtotal') * F('book__discount') / 100, 2, output_field=MONEY),
+    ).annotate(
+        total_price=F('line_subtotal') - F('line_discount'),
+    )
+
+
+# The same columns for one line outside a query (a cached cart line). ROUND() of numeric
+# rounds half away from zero, so the discount is rounded half up
+def line_totals(price, discount, quantity):
+    subtotal = Decimal(price) * quantity
+    line_discount = (subtotal * Decimal(discount) / 100).quantize(CENT, rounding=ROUND_HALF_UP)
+    return {'line_subtotal': subtotal, 'line_discount': line_discount, 'total_price': subtotal - line_discount}
+
+
+# Cart lines together with the cart totals in a single query: the totals are window
+# sums over the whole cart, repeated on every line
+def cart_summary(carts):
+    rows = list(
+        with_line_totals(carts)
+        .annotate(
+            subtotal=Window(Sum('line_subtotal'), output_field=MONEY),
+            discount_total=Window(Sum('line_discount'), output_field=MONEY),
+            total=Window(Sum('total_price'), output_field=MONEY),
+        )
+        .order_by('id')
+        .values(
+            'id', 'book_id', 'quantity', 'line_subtotal', 'line_discount', 'total_price',
+            'subtotal', 'discount_total', 'total',
+            book_title=F('book__title'), book_price=F('book__price'), discount=F('book__discount'),
+        )
+    )
+
+    totals = rows[0] if rows else {'subtotal': Decimal('0.00'), 'discount_total': Decimal('0.00'), 'total': Decimal('0.00')}
+    items = [
+        {key: value for key, value in row.items() if key not in ('subtotal', 'discount_total', 'total')}
+        for row in rows
+    ]
+    return {
+        'items': items,
+        'quantity': sum(item['quantity'] for item in items),
+        'subtotal': totals['subtotal'],
+        'discount': totals['discount_total'],
+        'total': totals['total'],
+    }
@@ -0,0 +1,109 @@
+import hashlib
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+from rest_framework.response import Response
+
+
+VERSION_KEY = 'catalog:version'
+HITS_KEY = 'catalog:hits'
+MISSES_KEY = 'catalog:misses'
+
+
+def get_catalog_cache():
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+# Run at startup, so a process-local catalog cache fails before serving stale responses
+def check_catalog_backend():
+    if isinstance(get_catalog_cache(), LocMemCache) and not settings.CATALOG_CACHE_ALLOW_LOCAL:
+        raise ImproperlyConfigured(
+            "The 'catalog' cache must be shared by all processes, set CATALOG_CACHE_BACKEND "
+            "(or CATALOG_CACHE_ALLOW_LOCAL=1 for a single process)."
+        )
+
+
+# Current catalog version. It starts from a timestamp, so a version lost by cache
+# eviction never comes back with the old number and resurrects stale responses
+def catalog_version():
+    cache = get_catalog_cache()
+    cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+    return cache.get(VERSION_KEY)
+
+
+# Every cached response is keyed by the version, so bumping it invalidates all of them at once
+def bump_catalog_version():
+    cache = get_catalog_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        catalog_version()
+
+
+# Bump the version once the current transaction commits, so a concurrent read
+# can't cache the old rows under the new version
+def invalidate_catalog():
+    transaction.on_commit(bump_catalog_version)
+
+
+def _count(key):
+    cache = get_catalog_cache()
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def catalog_cache_stats():
+    cache = get_catalog_cache()
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'version': catalog_version(),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 4) if total else None,
+    }
+
+
+# Cache successful responses of a catalog read action per full URL and catalog version.
+# ETag/Last-Modified are cached with the body, so a hit answers conditional requests
+# without touching the database. X-Cache tells whether the response came from the cache
+def cached_catalog_response(view_method):
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        cache = get_catalog_cache()
+        url_hash = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+        key = f'catalog:v{catalog_version()}:{url_hash}'
+
+        cached = cache.get(key)
+        if cached is not None:
+            _count(HITS_KEY)
+            data, headers = cached
+            response = get_conditional_response(
+                request,
+                etag=headers.get('ETag'),
+                last_modified=parse_http_date_safe(headers.get('Last-Modified')),
+            ) or Response(data)
+            for header, value in headers.items():
+                response[header] = value
+            response['X-Cache'] = 'HIT'
+            return response
+
+        _count(MISSES_KEY)
+        response = view_method(self, request, *args, **kwargs)
+        if response.status_code == 200:
+            headers = {header: response[header] for header in ('ETag', 'Last-Modified') if header in response}
+            cache.set(key, (response.data, headers), settings.CATALOG_CACHE_TIMEOUT)
+        response['X-Cache'] = 'MISS'
+        return response
+
+    return wrapper
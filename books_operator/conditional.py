@@ -0,0 +1,40 @@
+import hashlib
+from functools import wraps
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+# Answer GET requests with 304 Not Modified when the client already has the current payload.
+# get_queryset(view) returns the rows behind the response, the validators come from
+# one MAX(updated_at) / COUNT query over them, so the body is never serialized for a 304.
+# The count is part of the ETag because deletions don't move MAX(updated_at)
+def conditional_get(get_queryset):
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            try:
+                stats = get_queryset(self).order_by().aggregate(last_modified=Max('updated_at'), count=Count('pk'))
+            except (TypeError, ValueError):
+                # Malformed lookup from the URL (e.g. a non-numeric pk), the view answers 404
+                return view_method(self, request, *args, **kwargs)
+
+            # HTTP dates have one second resolution, the ETag keeps the exact time
+            last_modified = int(stats['last_modified'].timestamp()) if stats['last_modified'] else None
+
+            etag_source = f"{request.get_full_path()}:{request.user.pk}:{stats['last_modified']}:{stats['count']}"
+            etag = '"%s"' % hashlib.md5(etag_source.encode()).hexdigest()
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = view_method(self, request, *args, **kwargs)
+
+            if response.status_code in (200, 304):
+                response['ETag'] = etag
+                if last_modified is not None:
+                    response['Last-Modified'] = http_date(last_modified)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,157 @@
+import json
+import struct
+import threading
+from datetime import datetime
+import msgpack
+from django.conf import settings
+from django.utils import timezone
+
+
+# Wire format of binary events: magic byte 0, 4-byte big-endian schema version, then a
+# msgpack array of the field values in schema order. Field names are not repeated in every
+# message, datetimes are msgpack timestamps. Decimals stay strings, so no precision is lost.
+# JSON events are plain objects, a consumer tells the two apart by the first byte
+MAGIC = 0
+HEADER = struct.Struct('>BI')
+ENCODINGS = ('msgpack', 'json')
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def _to_datetime(value):
+    value = datetime.fromisoformat(value) if isinstance(value, str) else value
+    return value if timezone.is_aware(value) else timezone.make_aware(value)
+
+
+# Field types: how a payload value is packed and how it is turned back into the payload value.
+# A 'records' field is a list of objects described by its own 'fields', packed as lists too
+FIELD_TYPES = {
+    'string': (str, lambda value: value),
+    'int': (int, lambda value: value),
+    'decimal': (str, lambda value: value),
+    'datetime': (_to_datetime, lambda value: value.isoformat()),
+    'records': (None, None),
+}
+
+
+def _check_types(fields, where):
+    for field in fields:
+        if field['type'] not in FIELD_TYPES:
+            raise SchemaError(f'{where}: unknown field type {field["type"]}')
+        if field['type'] == 'records':
+            _check_types(field['fields'], f'{where}.{field["name"]}')
+
+
+def _pack(fields, record, where):
+    unknown = set(record) - {field['name'] for field in fields}
+    if unknown:
+        raise SchemaError(f'{where}: fields not in the schema: {", ".join(sorted(unknown))}')
+
+    values = []
+    for field in fields:
+        value = record.get(field['name'])
+        if value is None:
+            values.append(None)
+        elif field['type'] == 'records':
+            values.append([_pack(field['fields'], item, f'{where}.{field["name"]}') for item in value])
+        else:
+            values.append(FIELD_TYPES[field['type']][0](value))
+    return values
+
+
+def _unpack(fields, values, where):
+    if len(values) != len(fields):
+        raise SchemaError(f'{where}: expected {len(fields)} values, got {len(values)}')
+
+    record = {}
+    for field, value in zip(fields, values):
+        if value is None:
+            record[field['name']] = None
+        elif field['type'] == 'records':
+            record[field['name']] = [_unpack(field['fields'], item, f'{where}.{field["name"]}') for item in value]
+        else:
+            record[field['name']] = FIELD_TYPES[field['type']][1](value)
+    return record
+
+
+# Local stand-in for a schema registry: versions of every topic's schema in a JSON file
+# (EVENT_SCHEMA_PATH). New versions are appended to the topic's list, the last one is used for encoding
+class SchemaRegistry:
+    def __init__(self, path):
+        with open(path, encoding='utf-8') as file:
+            topics = json.load(file)
+        self.schemas = {
+            topic: {schema['version']: schema['fields'] for schema in versions}
+            for topic, versions in topics.items()
+        }
+        for topic, versions in self.schemas.items():
+            for version, fields in versions.items():
+                _check_types(fields, f'{topic} v{version}')
+
+    def has_schema(self, topic):
+        return topic in self.schemas
+
+    def latest(self, topic):
+        version = max(self.schemas[topic])
+        return version, self.schemas[topic][version]
+
+    def get(self, topic, version):
+        try:
+            return self.schemas[topic][version]
+        except KeyError:
+            raise SchemaError(f'{topic}: no schema version {version}')
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+# The schema file is read once per path
+def get_schema_registry():
+    path = settings.EVENT_SCHEMA_PATH
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = SchemaRegistry(path)
+        return _registries[path]
+
+
+# EVENT_ENCODINGS picks the encoding per topic, EVENT_DEFAULT_ENCODING (json) the rest.
+# Topics without a schema are always JSON
+def topic_encoding(topic):
+    encoding = settings.EVENT_ENCODINGS.get(topic, settings.EVENT_DEFAULT_ENCODING)
+    if encoding not in ENCODINGS:
+        raise SchemaError(f'{topic}: unknown encoding {encoding}')
+    if encoding == 'msgpack' and not get_schema_registry().has_schema(topic):
+        return 'json'
+    return encoding
+
+
+# Schema version new events of the topic are written with, None for topics without a schema
+def current_version(topic):
+    registry = get_schema_registry()
+    return registry.latest(topic)[0] if registry.has_schema(topic) else None
+
+
+# version is the schema version the payload was written with, the latest one by default
+def encode_event(topic, payload, encoding=None, version=None):
+    if (encoding or topic_encoding(topic)) == 'json':
+        return json.dumps(payload)
+
+    registry = get_schema_registry()
+    if version is None:
+        version, fields = registry.latest(topic)
+    else:
+        fields = registry.get(topic, version)
+    values = _pack(fields, payload, f'{topic} v{version}')
+    return HEADER.pack(MAGIC, version) + msgpack.packb(values, datetime=True)
+
+
+def decode_event(topic, value):
+    if isinstance(value, str) or value[:1] != bytes([MAGIC]):
+        return json.loads(value)
+
+    _, version = HEADER.unpack_from(value)
+    fields = get_schema_registry().get(topic, version)
+    return _unpack(fields, msgpack.unpackb(value[HEADER.size:], timestamp=3), f'{topic} v{version}')
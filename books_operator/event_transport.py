@@ -0,0 +1,82 @@
+import base64
+import json
+import threading
+from django.conf import settings
+from .kafka_producer import get_producer_service, send_messages
+
+
+# Where events are produced to, chosen by the EVENT_TRANSPORT setting. Every transport takes
+# (topic, key, value) messages, value being the encoded event (str or bytes).
+# send_batch() returns the indexes of the messages that were not delivered
+
+class KafkaTransport:
+    def send(self, topic, key, value):
+        return get_producer_service().produce(topic, value, key=key)
+
+    def send_batch(self, messages):
+        return send_messages(messages)
+
+
+# Keeps the messages in a list, for assertions in tests
+class InMemoryTransport:
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def send(self, topic, key, value):
+        with self.lock:
+            self.messages.append((topic, key, value))
+        return True
+
+    def send_batch(self, messages):
+        with self.lock:
+            self.messages.extend(messages)
+        return set()
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
+
+
+# Appends one JSON line per message to EVENT_TRANSPORT_PATH. Binary values are base64 encoded
+class FileTransport:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def line(topic, key, value):
+        record = {'topic': topic, 'key': key}
+        if isinstance(value, bytes):
+            record['value_b64'] = base64.b64encode(value).decode('ascii')
+        else:
+            record['value'] = value
+        return json.dumps(record) + '\n'
+
+    def send(self, topic, key, value):
+        return not self.send_batch([(topic, key, value)])
+
+    def send_batch(self, messages):
+        lines = ''.join(self.line(*message) for message in messages)
+        with self.lock, open(self.path, 'a', encoding='utf-8') as file:
+            file.write(lines)
+        return set()
+
+
+EVENT_TRANSPORTS = {
+    'kafka': KafkaTransport,
+    'memory': InMemoryTransport,
+    'file': lambda: FileTransport(settings.EVENT_TRANSPORT_PATH),
+}
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+# One instance per transport name, so the in-memory transport keeps its messages between calls
+def get_event_transport(name=None):
+    name = name or settings.EVENT_TRANSPORT
+    with _transports_lock:
+        if name not in _transports:
+            _transports[name] = EVENT_TRANSPORTS[name]()
+        return _transports[name]
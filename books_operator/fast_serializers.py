@@ -0,0 +1,167 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+
+# Read-only list rendering straight from .values() rows.
+# Fields keep the conversion of the regular serializer (field.to_representation), so the
+# output is the same, but no model instance or per-row serializer is ever built.
+# build() returns None for serializers it can't reproduce, callers then fall back to them
+class ValuesSerializer:
+
+    def __init__(self, serializer, queryset, fields, nested):
+        self.serializer = serializer
+        self.queryset = queryset
+        self.fields = fields
+        self.nested = nested
+        self.finalize = getattr(serializer, 'finalize_representation', None)
+
+    @classmethod
+    def build(cls, serializer, queryset):
+        model = queryset.model
+        fields, nested = [], []
+        value_sources = getattr(serializer, 'value_sources', {})
+
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+
+            if isinstance(field, serializers.ListSerializer):
+                child = cls._build_nested(field, model)
+                if child is None:
+                    return None
+                nested.append((name, child))
+                fields.append((name, None, None))
+                continue
+
+            key = value_sources.get(name) or cls._values_key(field, model, queryset)
+            if key is False:
+                return None
+            if key is None:
+                # Read-only source missing on the model, the serializer skips it too
+                continue
+
+            if isinstance(field, serializers.PrimaryKeyRelatedField):
+                fields.append((name, key, None))
+            else:
+                fields.append((name, key, cls._converter(field)))
+
+        return cls(serializer, queryset, fields, nested)
+
+    # field.to_representation, with the per-value work of the hot decimal and
+    # datetime fields resolved once per list instead of once per row
+    @staticmethod
+    def _converter(field):
+        if isinstance(field, serializers.DateTimeField):
+            output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+            field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+            if output_format is None or output_format.lower() != ISO_8601 or field_timezone is None:
+                return field.to_representation
+
+            def datetime_to_representation(value):
+                if isinstance(value, str) or value.tzinfo is None:
+                    return field.to_representation(value)
+                value = value.astimezone(field_timezone).isoformat()
+                if value.endswith('+00:00'):
+                    value = value[:-6] + 'Z'
+                return value
+
+            return datetime_to_representation
+
+        if isinstance(field, serializers.DecimalField):
+            coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+            if field.decimal_places is None or field.normalize_output or field.localize:
+                return field.to_representation
+
+            # Database values of the column scale are already quantized
+            def decimal_to_representation(value):
+                if not isinstance(value, Decimal) or value.as_tuple().exponent != -field.decimal_places:
+                    return field.to_representation(value)
+                return '{:f}'.format(value) if coerce_to_string else value
+
+            return decimal_to_representation
+
+        return field.to_representation
+
+    # Path of the field source in .values() terms: None when the field is skipped,
+    # False when it can't be read from values at all
+    @staticmethod
+    def _values_key(field, model, queryset):
+        path = field.source.split('.')
+        if path == ['*']:
+            return False
+        if len(path) == 1 and path[0] in queryset.query.annotations:
+            return path[0]
+
+        for index, part in enumerate(path):
+            try:
+                model_field = model._meta.get_field(part)
+            except FieldDoesNotExist:
+                return None if field.read_only and not field.required else False
+
+            is_last = index == len(path) - 1
+            if not model_field.concrete or (model_field.is_relation and not (model_field.many_to_one or model_field.one_to_one)):
+                return False
+            if model_field.is_relation and not is_last:
+                model = model_field.related_model
+                continue
+            if model_field.is_relation and part == model_field.name and not isinstance(field, serializers.PrimaryKeyRelatedField):
+                return False
+
+        return '__'.join(path)
+
+    @classmethod
+    def _build_nested(cls, field, model):
+        try:
+            relation = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            return None
+        if not relation.one_to_many:
+            return None
+
+        queryset = relation.related_model._default_manager.all()
+        child = cls.build(field.child, queryset)
+        if child is None:
+            return None
+        child.parent_key = relation.field.name
+        return child
+
+    def value_keys(self):
+        return [key for _, key, _ in self.fields if key is not None]
+
+    def values(self, queryset, *extra):
+        keys = self.value_keys()
+        if self.nested:
+            keys.append('pk')
+        return queryset.values(*dict.fromkeys([*keys, *extra]))
+
+    def render(self, rows):
+        rows = list(rows)
+        children = {name: child.render_grouped([row['pk'] for row in rows]) for name, child in self.nested}
+
+        data = []
+        for row in rows:
+            representation = {}
+            for name, key, to_representation in self.fields:
+                if key is None:
+                    representation[name] = children[name].get(row['pk'], [])
+                    continue
+                value = row[key]
+                if value is None or to_representation is None:
+                    representation[name] = value
+                else:
+                    representation[name] = to_representation(value)
+            if self.finalize:
+                representation = self.finalize(representation)
+            data.append(representation)
+        return data
+
+    # Nested rows of all parents in one query, grouped by parent id
+    def render_grouped(self, parent_ids):
+        rows = list(self.values(self.queryset.filter(**{f'{self.parent_key}__in': parent_ids}), self.parent_key))
+        grouped = defaultdict(list)
+        for row, representation in zip(rows, self.render(rows)):
+            grouped[row[self.parent_key]].append(representation)
+        return grouped
@@ -0,0 +1,64 @@
+import hashlib
+import json
+from functools import wraps
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+from .models import IdempotencyKey
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+def request_fingerprint(request):
+    return hashlib.md5(json.dumps(request.data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Keys are per user. Anonymous clients (signup) don't share one scope: they are told apart
+# by their address, so a client can't get another one's stored response by reusing its key
+def client_identity(request):
+    if request.user.is_authenticated:
+        return request.user.pk
+    return f'anonymous@{request.META.get("REMOTE_ADDR", "")}'
+
+
+# Run a POST action once per Idempotency-Key header: retries with the same key get the stored
+# response back without running the action again. The key row is inserted in the same
+# transaction as the action's writes, so a concurrent request with the same key blocks on the
+# unique constraint until the first one commits and then reads its response. Requests without
+# the header, and actions that raise or answer 5xx, are not stored
+def idempotent(view_method):
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return view_method(self, request, *args, **kwargs)
+        if not key or len(key) > 255:
+            return Response({"error": f"{IDEMPOTENCY_HEADER} must be 1 to 255 characters."}, status=status.HTTP_400_BAD_REQUEST)
+
+        scope = f'{request.path}:{client_identity(request)}'
+        fingerprint = request_fingerprint(request)
+
+        with transaction.atomic():
+            record, created = IdempotencyKey.objects.get_or_create(key=key, scope=scope, defaults={'request_hash': fingerprint})
+
+            if not created:
+                if record.request_hash != fingerprint:
+                    return Response(
+                        {"error": f"This {IDEMPOTENCY_HEADER} was already used with a different request."},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    )
+                response = Response(record.response, status=record.status_code)
+                response['Idempotent-Replayed'] = 'true'
+                return response
+
+            response = view_method(self, request, *args, **kwargs)
+            if response.status_code >= 500:
+                record.delete()
+            else:
+                record.status_code = response.status_code
+                record.response = response.data
+                record.save(update_fields=['status_code', 'response'])
+            return response
+
+    return wrapper
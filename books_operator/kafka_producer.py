@@ -1,19 +1,152 @@
+import atexit
+import logging
+import threading
+import time
 from confluent_kafka import Producer
+from django.conf import settings
 
 
-config = {
-    'bootstrap.servers': 'kafka:9092',
-}
+__all__ = ['get_producer_service', 'producer_stats', 'send_message', 'send_messages']
+
+logger = logging.getLogger(__name__)
+
+
+# What produce() does when the local producer queue is full:
+# 'block' polls for deliveries until there is room or KAFKA_PRODUCER_BLOCK_TIMEOUT passes, then raises,
+# 'drop' counts the message as dropped and returns, 'raise' raises BufferError at once
+BACKPRESSURE_MODES = ('block', 'drop', 'raise')
+
+
+def producer_config():
+    return {
+        'bootstrap.servers': settings.KAFKA_BROKER_URL,
+        'linger.ms': settings.KAFKA_PRODUCER_LINGER_MS,
+        'batch.size': settings.KAFKA_PRODUCER_BATCH_SIZE,
+        'compression.type': settings.KAFKA_PRODUCER_COMPRESSION,
+        'queue.buffering.max.messages': settings.KAFKA_PRODUCER_QUEUE_SIZE,
+    }
 
 
 def delivery_report(err, msg):
     if err is not None:
-        print(f'Message delivery failed: {err}')
-    else:
-        print(f'Message delivered to {msg.topic()} [{msg.partition()}]')
+        logger.warning('Message delivery to %s failed: %s', msg.topic(), err)
+
+
+# One producer per process. produce() only hands the message to the librdkafka queue, a
+# background thread polls delivery callbacks, so batching, linger and compression happen
+# on the client and a request never waits for the broker. Outstanding messages are
+# flushed when the process exits
+class ProducerService:
+
+    def __init__(self, config, backpressure='block', block_timeout=5.0):
+        if backpressure not in BACKPRESSURE_MODES:
+            raise ValueError(f'backpressure must be one of {BACKPRESSURE_MODES}')
+        self.producer = Producer(config)
+        self.backpressure = backpressure
+        self.block_timeout = block_timeout
+        self.counters = {'queued': 0, 'delivered': 0, 'failed': 0, 'dropped': 0}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.poller = threading.Thread(target=self.poll_loop, name='kafka-producer-poll', daemon=True)
+        self.poller.start()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'in_flight': len(self.producer)}
+
+    def poll_loop(self):
+        while not self.stopped.is_set():
+            self.producer.poll(0.1)
+
+    # Returns False when the message was dropped by backpressure
+    def produce(self, topic, value, key=None, on_delivery=None):
+        def callback(err, msg):
+            self.count('failed' if err is not None else 'delivered')
+            delivery_report(err, msg)
+            if on_delivery is not None:
+                on_delivery(err, msg)
+
+        waited = 0.0
+        while True:
+            try:
+                self.producer.produce(topic, value=value, key=key, on_delivery=callback)
+                self.count('queued')
+                return True
+            except BufferError:
+                if self.backpressure == 'drop':
+                    self.count('dropped')
+                    return False
+                if self.backpressure == 'raise' or waited >= self.block_timeout:
+                    raise
+                # Deliveries free up room in the queue
+                self.producer.poll(0.1)
+                waited += 0.1
+
+    def flush(self, timeout=30):
+        return self.producer.flush(timeout)
+
+    def close(self, timeout=30):
+        self.stopped.set()
+        self.poller.join()
+        remaining = self.flush(timeout)
+        if remaining:
+            logger.warning('%s messages were not delivered before shutdown', remaining)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+# The producer is created on first use, importing this module never connects to the broker
+def get_producer_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ProducerService(
+                producer_config(),
+                backpressure=settings.KAFKA_PRODUCER_BACKPRESSURE,
+                block_timeout=settings.KAFKA_PRODUCER_BLOCK_TIMEOUT,
+            )
+            atexit.register(_service.close)
+        return _service
+
+
+def producer_stats():
+    return get_producer_service().stats()
+
+
+def send_message(topic, message, key=None):
+    return get_producer_service().produce(topic, message, key=key)
+
+
+# Produce (topic, key, message) tuples and wait until all of them are delivered or failed,
+# at most timeout seconds in total. Returns the indexes of the messages that were not delivered
+def send_messages(messages, timeout=30):
+    deadline = time.monotonic() + timeout
+    service = get_producer_service()
+    failed = set(range(len(messages)))
+    done = threading.Semaphore(0)
+
+    def on_delivery(index):
+        def callback(err, msg):
+            if err is None:
+                failed.discard(index)
+            done.release()
+        return callback
 
-producer = Producer(config)
+    produced = 0
+    for index, (topic, key, message) in enumerate(messages):
+        if not service.produce(topic, message, key=key, on_delivery=on_delivery(index)):
+            break
+        produced += 1
 
-def send_message(topic, message):
-    producer.produce(topic, value=message, callback=delivery_report)
-    producer.flush()
+    service.flush(max(deadline - time.monotonic(), 0))
+    for _ in range(produced):
+        if not done.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            break
+    # Late delivery reports keep changing failed, the caller gets a snapshot
+    return set(failed)
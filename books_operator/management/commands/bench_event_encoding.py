@@ -0,0 +1,72 @@
+import time
+from datetime import datetime, timezone
+from django.core.management.base import BaseCommand
+from books_operator.event_schemas import decode_event, encode_event
+
+
+class Command(BaseCommand):
+    help = 'Compare size and encode/decode speed of the JSON and msgpack event encodings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        for topic, payloads in self.payloads(options['events']).items():
+            results = {encoding: self.bench(topic, payloads, encoding, options['repeat']) for encoding in ('json', 'msgpack')}
+            json_size = results['json'][0]
+            for encoding, (size, encode_time, decode_time) in results.items():
+                self.stdout.write(
+                    f'{topic} {encoding}: {size / len(payloads):.1f} bytes/event ({size / json_size:.0%} of JSON), '
+                    f'encode {len(payloads) / encode_time:.0f} events/s, decode {len(payloads) / decode_time:.0f} events/s'
+                )
+
+    @staticmethod
+    def payloads(count):
+        now = datetime.now(timezone.utc).isoformat()
+        return {
+            'order_topic': [
+                {
+                    'order_action': 'update', 'order_id': i, 'customer_id': i % 1000, 'status': 'shipped',
+                    'total_price': '39.98', 'created_at': now, 'updated_at': now,
+                }
+                for i in range(count)
+            ],
+            'order_items_topic': [
+                {
+                    'order_id': i, 'purchase_date': now, 'chunk': 0, 'chunks': 1,
+                    'items': [
+                        {
+                            'book_id': (i + j) % 5000, 'book_title': f'Book {(i + j) % 5000}', 'quantity': 2,
+                            'price': '19.99', 'discount': '5.00', 'total_price': '37.98',
+                        }
+                        for j in range(3)
+                    ],
+                }
+                for i in range(count)
+            ],
+            'customer_topic': [
+                {
+                    'user_action': 'update', 'customer_id': i, 'username': f'customer{i}', 'phone_number': '+375291234567',
+                    'spent_money': '120.50', 'date_joined': now,
+                }
+                for i in range(count)
+            ],
+        }
+
+    # Total encoded size and the best encode/decode time of all runs
+    @staticmethod
+    def bench(topic, payloads, encoding, repeat):
+        encode_time = decode_time = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            values = [encode_event(topic, payload, encoding) for payload in payloads]
+            encode_time = min(encode_time, time.perf_counter() - started)
+
+            started = time.perf_counter()
+            for value in values:
+                decode_event(topic, value)
+            decode_time = min(decode_time, time.perf_counter() - started)
+
+        size = sum(len(value.encode('utf-8') if isinstance(value, str) else value) for value in values)
+        return size, encode_time, decode_time
@@ -0,0 +1,57 @@
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from django.core.management.base import BaseCommand, CommandError
+from books_operator.event_transport import EVENT_TRANSPORTS, FileTransport
+
+
+class Command(BaseCommand):
+    help = 'Measure events per second of the event transports, one by one and in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=10000)
+        parser.add_argument('--batch-size', type=int, default=500)
+        # kafka needs a running broker, so it is opt-in
+        parser.add_argument('--transports', nargs='+', default=['memory', 'file'])
+
+    def handle(self, *args, **options):
+        unknown = set(options['transports']) - set(EVENT_TRANSPORTS)
+        if unknown:
+            raise CommandError(f'Unknown transports: {", ".join(sorted(unknown))}')
+
+        messages = self.messages(options['events'])
+        with tempfile.TemporaryDirectory() as directory:
+            for name in options['transports']:
+                # The file transport writes to a temporary file, not to EVENT_TRANSPORT_PATH
+                transport = FileTransport(os.path.join(directory, f'{name}.ndjson')) if name == 'file' else EVENT_TRANSPORTS[name]()
+                self.bench(name, transport, messages, options['batch_size'])
+
+    @staticmethod
+    def messages(count):
+        now = datetime.now(timezone.utc).isoformat()
+        return [
+            ('order_topic', str(i), json.dumps({
+                'order_action': 'create', 'order_id': i, 'customer_id': i % 1000, 'status': 'pending',
+                'total_price': '39.98', 'created_at': now, 'updated_at': now,
+            }))
+            for i in range(count)
+        ]
+
+    def bench(self, name, transport, messages, batch_size):
+        started = time.perf_counter()
+        for message in messages:
+            transport.send(*message)
+        send_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        failed = 0
+        for start in range(0, len(messages), batch_size):
+            failed += len(transport.send_batch(messages[start:start + batch_size]))
+        batch_time = time.perf_counter() - started
+
+        self.stdout.write(
+            f'{name}: {len(messages)} events, send {len(messages) / send_time:.0f} events/s, '
+            f'send_batch {len(messages) / batch_time:.0f} events/s, failed {failed}'
+        )
@@ -0,0 +1,72 @@
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from books_operator.fast_serializers import ValuesSerializer
+from books_operator.models import Book, Order, OrderItem
+from books_operator.serializers import BookSerializer, OrderSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compare list serialization through ModelSerializer and the .values() fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        # Benchmark rows live only inside this transaction
+        try:
+            with transaction.atomic():
+                self.run(options['rows'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, rows, repeat):
+        books = Book.objects.bulk_create(
+            Book(
+                title=f'Book {i}', author=f'Author {i % 100}', description='D' * 500, synopsis='S' * 500,
+                genre='Genre', price=Decimal('19.99'), discount=Decimal('5.00'), stock=i % 7,
+            )
+            for i in range(rows)
+        )
+        orders = Order.objects.bulk_create(Order() for _ in range(rows // 3))
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, book=books[i], quantity=2, price=Decimal('19.99'))
+            for i, order in enumerate(orders)
+        )
+
+        self.bench('Book', BookSerializer, Book.objects.order_by('id'), repeat)
+        self.bench('Order', OrderSerializer, Order.objects.order_by('id'), repeat)
+
+    def bench(self, name, serializer_class, queryset, repeat):
+        serializer_output = fast_output = None
+        serializer_time = fast_time = float('inf')
+
+        for _ in range(repeat):
+            started = time.perf_counter()
+            serializer_output = JSONRenderer().render(serializer_class(queryset.prefetch_related(*self.nested(serializer_class)), many=True).data)
+            serializer_time = min(serializer_time, time.perf_counter() - started)
+
+            started = time.perf_counter()
+            fast_serializer = ValuesSerializer.build(serializer_class(), queryset)
+            fast_output = JSONRenderer().render(fast_serializer.render(fast_serializer.values(queryset)))
+            fast_time = min(fast_time, time.perf_counter() - started)
+
+        if serializer_output != fast_output:
+            raise CommandError(f'{name}: fast path output differs from the serializer output')
+
+        self.stdout.write(
+            f'{name}: {queryset.count()} rows, serializer {serializer_time * 1000:.1f} ms, '
+            f'values {fast_time * 1000:.1f} ms, speedup x{serializer_time / fast_time:.1f}'
+        )
+
+    @staticmethod
+    def nested(serializer_class):
+        return [name for name, field in serializer_class().fields.items() if hasattr(field, 'child')]
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from books_operator.cart_store import get_cart_store
+
+
+class Command(BaseCommand):
+    help = 'Write carts held by the cart store (CART_STORAGE=cache) back to the Cart table'
+
+    def handle(self, *args, **options):
+        flushed = get_cart_store().flush_all()
+        self.stdout.write(self.style.SUCCESS(f'Flushed {flushed} carts.'))
@@ -0,0 +1,29 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from books_operator.review_import import IMPORT_BATCH_SIZE, ImportFormatError, import_reviews, read_csv, read_ndjson
+
+
+class Command(BaseCommand):
+    help = 'Import reviews from an NDJSON or CSV file (user,book,rating,comment), batch by batch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['ndjson', 'csv'], help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        read_rows = read_csv if file_format == 'csv' else read_ndjson
+
+        try:
+            with open(path, encoding='utf-8', newline='') as file:
+                report = import_reviews(read_rows(file), batch_size=options['batch_size'])
+        except (OSError, ImportFormatError) as error:
+            raise CommandError(error)
+
+        for error in report['errors']:
+            self.stderr.write(f"Row {error['row']}: {json.dumps(error['errors'])}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {report['created']} reviews, skipped {report['skipped']} duplicates, rejected {len(report['errors'])} rows."
+        ))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min, Max
+from books_operator.models import Book
+from books_operator.ratings import rebuild_ratings
+
+
+class Command(BaseCommand):
+    help = 'Recount denormalized book rating counters from reviews, chunk by chunk of book ids'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        bounds = Book.objects.aggregate(first=Min('id'), last=Max('id'))
+
+        rebuilt = 0
+        if bounds['first'] is not None:
+            # Each chunk is its own short transaction, so book rows are never locked for long
+            for start in range(bounds['first'], bounds['last'] + 1, chunk_size):
+                with transaction.atomic():
+                    rebuilt += rebuild_ratings(Book.objects.filter(id__gte=start, id__lt=start + chunk_size))
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt ratings for {rebuilt} books.'))
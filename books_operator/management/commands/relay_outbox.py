@@ -0,0 +1,28 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from books_operator.outbox import prune_sent, relay_batch
+
+
+class Command(BaseCommand):
+    help = 'Produce outbox events to Kafka in id order, mark them sent and prune old sent events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--once', action='store_true', help='Drain the outbox and exit')
+
+    def handle(self, *args, **options):
+        sent = failed = 0
+        while True:
+            batch_sent, batch_failed = relay_batch(options['batch_size'])
+            sent += batch_sent
+            failed += batch_failed
+
+            # An empty or undelivered batch means there is nothing to send right now
+            if batch_sent + batch_failed < options['batch_size']:
+                pruned = prune_sent(settings.OUTBOX_RETENTION_HOURS)
+                if options['once']:
+                    self.stdout.write(self.style.SUCCESS(f'Sent {sent} events, failed to encode {failed}, pruned {pruned}.'))
+                    return
+                time.sleep(options['interval'])
@@ -0,0 +1,33 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min, Max
+from django.utils import timezone
+from books_operator.models import Cart
+
+
+class Command(BaseCommand):
+    help = 'Delete cart lines added more than CART_TTL_DAYS ago, chunk by chunk of cart ids'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl-days', type=int, default=None, help='Defaults to CART_TTL_DAYS')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        ttl_days = settings.CART_TTL_DAYS if options['ttl_days'] is None else options['ttl_days']
+        chunk_size = options['chunk_size']
+        cutoff = timezone.now() - timedelta(days=ttl_days)
+
+        abandoned = Cart.objects.filter(added_at__lt=cutoff)
+        bounds = abandoned.aggregate(first=Min('id'), last=Max('id'))
+
+        deleted = 0
+        if bounds['first'] is not None:
+            # Each chunk is its own short transaction, so cart rows are never locked for long
+            for start in range(bounds['first'], bounds['last'] + 1, chunk_size):
+                with transaction.atomic():
+                    chunk_deleted, _ = abandoned.filter(id__gte=start, id__lt=start + chunk_size).delete()
+                deleted += chunk_deleted
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} abandoned cart lines older than {ttl_days} days.'))
@@ -0,0 +1,32 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min, Max
+from django.utils import timezone
+from books_operator.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete stored Idempotency-Key responses older than IDEMPOTENCY_KEY_TTL_HOURS, chunk by chunk of ids'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl-hours', type=int, default=None, help='Defaults to IDEMPOTENCY_KEY_TTL_HOURS')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        ttl_hours = settings.IDEMPOTENCY_KEY_TTL_HOURS if options['ttl_hours'] is None else options['ttl_hours']
+        chunk_size = options['chunk_size']
+        cutoff = timezone.now() - timedelta(hours=ttl_hours)
+
+        expired = IdempotencyKey.objects.filter(created_at__lt=cutoff)
+        bounds = expired.aggregate(first=Min('id'), last=Max('id'))
+
+        deleted = 0
+        if bounds['first'] is not None:
+            for start in range(bounds['first'], bounds['last'] + 1, chunk_size):
+                with transaction.atomic():
+                    chunk_deleted, _ = expired.filter(id__gte=start, id__lt=start + chunk_size).delete()
+                deleted += chunk_deleted
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} idempotency keys older than {ttl_hours} hours.'))
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.2 on 2026-10-17 11:47
+
+import django.db.models.expressions
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books_operator', '0011_book_facet_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_avg',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(rating_count=0, then=models.Value(0)), default=django.db.models.expressions.CombinedExpression(django.db.models.functions.comparison.Cast('rating_sum', models.DecimalField(decimal_places=2, max_digits=12)), '/', models.F('rating_count')), output_field=models.DecimalField(decimal_places=2, max_digits=3)), output_field=models.DecimalField(decimal_places=2, max_digits=3)),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['rating_avg'], name='book_rating_avg_idx'),
+        ),
+    ]
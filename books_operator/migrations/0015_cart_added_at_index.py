@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-17 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books_operator', '0014_review_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='added_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
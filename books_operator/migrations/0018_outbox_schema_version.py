@@ -0,0 +1,43 @@
+# Generated by Django 5.1.2 on 2026-10-17 13:05
+
+from django.db import migrations, models
+
+
+# Events written before versions were recorded carry the payloads of the first schemas
+def mark_first_version(apps, schema_editor):
+    OutboxEvent = apps.get_model('books_operator', 'OutboxEvent')
+    OutboxEvent.objects.filter(topic__in=['order_topic', 'order_items_topic', 'customer_topic']).update(schema_version=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books_operator', '0017_outbox_event'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outboxevent',
+            name='outbox_unsent_idx',
+        ),
+        migrations.AddField(
+            model_name='outboxevent',
+            name='error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='outboxevent',
+            name='failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outboxevent',
+            name='schema_version',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(condition=models.Q(('failed_at__isnull', True), ('sent_at__isnull', True)), fields=['id'], name='outbox_pending_idx'),
+        ),
+        migrations.RunPython(mark_first_version, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,16 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db.models.functions import Cast
 from decimal import Decimal
 
 
+# Text search configuration used for the book search vector and queries
+BOOK_SEARCH_CONFIG = 'english'
+
+
 class Book(models.Model):
     title = models.CharField(max_length=255, blank=False, null=True)
     author = models.CharField(max_length=255,blank=False, null=True)
@@ -12,6 +20,42 @@ class Book(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     discount = models.DecimalField(max_digits=5, decimal_places=2, default=0.00)
     stock = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Denormalized review counters, kept in sync by ReviewViewSet with F() updates
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_avg = models.GeneratedField(
+        expression=models.Case(
+            models.When(rating_count=0, then=models.Value(0)),
+            default=Cast('rating_sum', models.DecimalField(max_digits=12, decimal_places=2)) / models.F('rating_count'),
+            output_field=models.DecimalField(max_digits=3, decimal_places=2),
+        ),
+        output_field=models.DecimalField(max_digits=3, decimal_places=2),
+        db_persist=True,
+    )
+    # Maintained by Postgres on every insert/update, weighted title > author > synopsis > description
+    search_vector = models.GeneratedField(
+        expression=(
+            SearchVector('title', weight='A', config=BOOK_SEARCH_CONFIG)
+            + SearchVector('author', weight='B', config=BOOK_SEARCH_CONFIG)
+            + SearchVector('synopsis', weight='C', config=BOOK_SEARCH_CONFIG)
+            + SearchVector('description', weight='D', config=BOOK_SEARCH_CONFIG)
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='book_search_vector_idx'),
+            GinIndex(fields=['title'], name='book_title_trgm_idx', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['author'], name='book_author_trgm_idx', opclasses=['gin_trgm_ops']),
+            models.Index(fields=['genre', 'price'], name='book_genre_price_idx'),
+            models.Index(fields=['author', 'price'], name='book_author_price_idx'),
+            models.Index(fields=['rating_avg', 'id'], name='book_rating_avg_id_idx'),
+            models.Index(fields=['price', 'id'], name='book_price_id_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -42,6 +86,11 @@ class Review(models.Model):
 
     class Meta:
         unique_together = ('user', 'book')
+        # Review feed of a book sorted by date or rating, id breaks ties of the keyset
+        indexes = [
+            models.Index(fields=['book', 'created_at', 'id'], name='review_book_created_idx'),
+            models.Index(fields=['book', 'rating', 'id'], name='review_book_rating_idx'),
+        ]
 
     def __str__(self):
         return f'Review by {self.user.username} for {self.book.title}'
@@ -51,7 +100,8 @@ class Cart(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
-    added_at = models.DateTimeField(auto_now_add=True)
+    # Indexed for the abandoned cart sweep (sweep_abandoned_carts)
+    added_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     class Meta:
         unique_together = ('customer', 'book')
@@ -79,8 +129,10 @@ class Order(models.Model):
     def __str__(self):
         return f'Order {self.id} by {self.customer.user.username}'
 
-    def calculate_total(self):
-        total = sum(item.get_total_price() for item in self.items.all())
+    # items can be passed in when they are already in memory (e.g. not saved yet)
+    def calculate_total(self, items=None):
+        items = self.items.all() if items is None else items
+        total = sum(item.get_total_price() for item in items)
         total -= total * ( Decimal(self.discount) / Decimal(100)) 
         return total
 
@@ -96,4 +148,46 @@ class OrderItem(models.Model):
         return f'{self.quantity} of {self.book.title} in order {self.order.id}'
 
     def get_total_price(self):
-        return self.price * self.quantity * (1 - self.discount / 100)
\ No newline at end of file
+        return self.price * self.quantity * (1 - self.discount / 100)
+
+
+# Response of a request sent with an Idempotency-Key header, replayed on retries of the same
+# request. scope ties the key to the route and the user. Swept by sweep_idempotency_keys
+class IdempotencyKey(models.Model):
+    key = models.CharField(max_length=255)
+    scope = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=32)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(encoder=DjangoJSONEncoder, null=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['key', 'scope'], name='idempotency_key_scope_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.key} for {self.scope}'
+
+
+# Event written in the same transaction as the change it describes and produced to Kafka
+# afterwards by the relay_outbox command, in id order. Sent rows are pruned by the relay
+class OutboxEvent(models.Model):
+    topic = models.CharField(max_length=255)
+    key = models.CharField(max_length=255, null=True, blank=True)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Schema version of the topic the payload was written with, it is encoded with that version
+    schema_version = models.PositiveIntegerField(null=True, blank=True)
+    # Set when the event can't be encoded, the relay skips it and it stays here for inspection
+    failed_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(sent_at__isnull=True, failed_at__isnull=True), name='outbox_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.topic} event {self.id}'
@@ -0,0 +1,60 @@
+from datetime import timedelta
+from django.db import connection, transaction
+from django.utils import timezone
+from .event_schemas import current_version, encode_event
+from .event_transport import get_event_transport
+from .models import OutboxEvent
+
+
+# Advisory lock key held by the relay batch being sent
+RELAY_LOCK_ID = 0x6f7574626f78
+
+
+# Record an event in the current transaction, it is produced only if the transaction commits.
+# The topic's current schema version is stored with it, so the relay encodes it with that
+# version even after a newer one is added
+def enqueue_event(topic, payload, key=None):
+    return OutboxEvent.objects.create(
+        topic=topic, payload=payload, key=None if key is None else str(key), schema_version=current_version(topic),
+    )
+
+
+# Encode the oldest pending events with the schema version they were written with, send them through the
+# event transport and mark the delivered ones sent. An event that can't be encoded is marked failed with
+# the error and skipped, it doesn't hold up the events behind it.
+# Batches are serialized by a transaction-level advisory lock: a second relay waits until the current
+# batch is committed, then picks up the events after it, so events are never sent out of id order
+# (per-order ordering relies on it). Only the delivered prefix of the batch is marked.
+# Returns the numbers of sent and failed events
+def relay_batch(batch_size):
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [RELAY_LOCK_ID])
+        events = list(
+            OutboxEvent.objects.select_for_update()
+            .filter(sent_at__isnull=True, failed_at__isnull=True)
+            .order_by('id')[:batch_size]
+        )
+        if not events:
+            return 0, 0
+
+        encoded, messages, failed_events = [], [], []
+        for event in events:
+            try:
+                messages.append((event.topic, event.key, encode_event(event.topic, event.payload, version=event.schema_version)))
+                encoded.append(event)
+            except (TypeError, ValueError) as error:
+                event.failed_at = timezone.now()
+                event.error = f'{type(error).__name__}: {error}'
+                failed_events.append(event)
+        OutboxEvent.objects.bulk_update(failed_events, ['failed_at', 'error'])
+
+        failed = get_event_transport().send_batch(messages) if messages else set()
+        delivered = encoded[:min(failed)] if failed else encoded
+        OutboxEvent.objects.filter(id__in=[event.id for event in delivered]).update(sent_at=timezone.now())
+    return len(delivered), len(failed_events)
+
+
+def prune_sent(retention_hours):
+    deleted, _ = OutboxEvent.objects.filter(sent_at__lt=timezone.now() - timedelta(hours=retention_hours)).delete()
+    return deleted
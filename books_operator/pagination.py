@@ -0,0 +1,117 @@
+import json
+from base64 import b64decode, b64encode
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+
+# Keyset pagination on the primary key. Every page is an index range scan
+# ("WHERE id > cursor ORDER BY id LIMIT n"), so deep pages cost the same as the first one
+class IdCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+# Keyset pagination on a composite key chosen by ?sort=. The cursor holds the whole key
+# of the last row, so the next page is "WHERE (rating, id) < (last rating, last id)" on the
+# matching index even when thousands of rows share the same leading value. Forward only
+class SortedKeysetPagination(IdCursorPagination):
+    sort_query_param = 'sort'
+    sort_orderings = {}
+    default_sort = None
+
+    def get_ordering(self, request, queryset, view):
+        sort = request.query_params.get(self.sort_query_param, self.default_sort)
+        if sort not in self.sort_orderings:
+            raise ValidationError({self.sort_query_param: f'Must be one of: {", ".join(self.sort_orderings)}.'})
+        return self.sort_orderings[sort]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        queryset = queryset.order_by(*self.ordering)
+        key = self.decode_key(request)
+        if key is not None:
+            queryset = queryset.filter(self.after(key))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    # (a, b) after (x, y) is "a > x OR (a = x AND b > y)", with each comparison following its field direction
+    def after(self, key):
+        condition = Q()
+        for index in reversed(range(len(self.ordering))):
+            field = self.ordering[index].lstrip('-')
+            lookup = 'lt' if self.ordering[index].startswith('-') else 'gt'
+            equal = {self.ordering[i].lstrip('-'): key[i] for i in range(index)}
+            condition = Q(**equal, **{f'{field}__{lookup}': key[index]}) | condition
+        return condition
+
+    def decode_key(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            key = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(key, list) or len(key) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return key
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        # str() keeps the microseconds of datetimes, they are part of the key
+        key = [self.read_field(last, field.lstrip('-')) for field in self.ordering]
+        encoded = b64encode(json.dumps(key, default=str).encode('utf-8')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_previous_link(self):
+        return None
+
+    # Page rows are model instances or .values() dicts
+    @staticmethod
+    def read_field(row, field):
+        return row[field] if isinstance(row, dict) else getattr(row, field)
+
+
+# Review feed of a book, served by the (book, created_at) and (book, rating) indexes
+class ReviewFeedPagination(SortedKeysetPagination):
+    sort_orderings = {
+        'newest': ('-created_at', '-id'),
+        'highest': ('-rating', '-id'),
+        'lowest': ('rating', 'id'),
+    }
+    default_sort = 'newest'
+
+
+# Ranked full-text search results. Many books share a rank, so the cursor holds
+# (rank, id) of the last row and the next page never falls back to an OFFSET over the ties
+class RankCursorPagination(SortedKeysetPagination):
+    sort_orderings = {'rank': ('-rank', 'id')}
+    default_sort = 'rank'
+
+
+# Book lists sorted by ?ordering=. Every key ends with id, so rows sharing a price or
+# a rating are paged by id on the (price, id) and (rating_avg, id) indexes
+class BookCursorPagination(SortedKeysetPagination):
+    sort_query_param = 'ordering'
+    sort_orderings = {
+        'id': ('id',),
+        '-id': ('-id',),
+        'price': ('price', 'id'),
+        '-price': ('-price', '-id'),
+        'rating_avg': ('rating_avg', 'id'),
+        '-rating_avg': ('-rating_avg', '-id'),
+        'rating_count': ('rating_count', 'id'),
+        '-rating_count': ('-rating_count', '-id'),
+    }
+    default_sort = 'id'
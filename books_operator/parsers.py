@@ -0,0 +1,25 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from .review_import import ImportFormatError, read_csv, read_ndjson
+
+
+# Newline delimited JSON body, parsed into a list of objects
+class NDJSONParser(BaseParser):
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return list(read_ndjson(stream))
+        except (ImportFormatError, UnicodeDecodeError) as error:
+            raise ParseError(str(error))
+
+
+# CSV body with a header line, parsed into a list of dicts
+class CSVParser(BaseParser):
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return list(read_csv(stream))
+        except (UnicodeDecodeError, ValueError) as error:
+            raise ParseError(f'CSV parse error - {error}')
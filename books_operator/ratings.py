@@ -0,0 +1,28 @@
+from django.db.models import F, Count, Sum, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .catalog_cache import invalidate_catalog
+from .models import Book, Review
+
+
+# Shift the rating counters of one book by a review change in a single UPDATE,
+# so concurrent reviews never overwrite each other
+def apply_rating_change(book_id, count_delta, sum_delta):
+    Book.objects.filter(pk=book_id).update(
+        rating_count=F('rating_count') + count_delta,
+        rating_sum=F('rating_sum') + sum_delta,
+        updated_at=timezone.now(),
+    )
+    invalidate_catalog()
+
+
+# Recount the rating counters of the given books from their reviews in a single UPDATE
+def rebuild_ratings(books):
+    reviews = Review.objects.filter(book=OuterRef('pk')).order_by().values('book')
+    updated = books.update(
+        rating_count=Coalesce(Subquery(reviews.annotate(count=Count('id')).values('count')), 0),
+        rating_sum=Coalesce(Subquery(reviews.annotate(total=Sum('rating')).values('total')), 0),
+        updated_at=timezone.now(),
+    )
+    invalidate_catalog()
+    return updated
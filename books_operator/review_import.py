@@ -0,0 +1,121 @@
+import csv
+import io
+import json
+from itertools import islice
+from django.db import IntegrityError, transaction
+from .models import Book, Review, User
+from .ratings import rebuild_ratings
+from .serializers import ReviewImportSerializer
+
+
+IMPORT_BATCH_SIZE = 1000
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+# Rows of an NDJSON stream, one JSON object per line, blank lines are skipped
+def read_ndjson(lines):
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            raise ImportFormatError(f'Line {number}: invalid JSON ({error}).')
+        yield row
+
+
+# Rows of a CSV stream with a header line (user,book,rating,comment)
+def read_csv(lines):
+    if not isinstance(lines, io.TextIOBase):
+        lines = (line.decode('utf-8') if isinstance(line, bytes) else line for line in lines)
+    yield from csv.DictReader(lines)
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+# Import reviews batch by batch. Every batch costs a fixed number of queries: users, books
+# and already reviewed (user, book) pairs are looked up once, the reviews go in with one
+# INSERT and the rating counters of the touched books are recounted once.
+# Returns the number of created and skipped rows and the errors of the rejected ones
+def import_reviews(rows, batch_size=IMPORT_BATCH_SIZE):
+    report = {'created': 0, 'skipped': 0, 'errors': []}
+    seen = set()
+    offset = 0
+
+    for batch in batched(rows, batch_size):
+        import_batch(batch, offset, seen, report)
+        offset += len(batch)
+
+    return report
+
+
+def import_batch(batch, offset, seen, report):
+    valid = []
+    for index, row in enumerate(batch, start=offset + 1):
+        serializer = ReviewImportSerializer(data=row)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            report['errors'].append({'row': index, 'errors': serializer.errors})
+
+    user_ids = {data['user'] for _, data in valid}
+    book_ids = {data['book'] for _, data in valid}
+    users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+    books = set(Book.objects.filter(id__in=book_ids).values_list('id', flat=True))
+    # Superset of the existing pairs in one query, exact pairs are matched in memory
+    existing = set(
+        Review.objects.filter(user__in=user_ids, book__in=book_ids).values_list('user_id', 'book_id')
+    )
+
+    reviews = []
+    for index, data in valid:
+        pair = (data['user'], data['book'])
+        if data['user'] not in users:
+            report['errors'].append({'row': index, 'errors': {'user': ['User not found.']}})
+        elif data['book'] not in books:
+            report['errors'].append({'row': index, 'errors': {'book': ['Book not found.']}})
+        elif pair in existing or pair in seen:
+            report['skipped'] += 1
+        else:
+            seen.add(pair)
+            reviews.append(Review(user_id=data['user'], book_id=data['book'], rating=data['rating'], comment=data['comment']))
+
+    if not reviews:
+        return
+
+    with transaction.atomic():
+        reviews = insert_new_reviews(reviews, report)
+        if reviews:
+            rebuild_ratings(Book.objects.filter(id__in={review.book_id for review in reviews}))
+    report['created'] += len(reviews)
+
+
+# A review written concurrently since the lookup fails the unique (user, book) constraint.
+# The pairs that exist by then are skipped and the rest is inserted again, so only
+# the rows really inserted are reported as created. Returns them
+def insert_new_reviews(reviews, report):
+    while reviews:
+        try:
+            with transaction.atomic():
+                Review.objects.bulk_create(reviews)
+            return reviews
+        except IntegrityError:
+            existing = set(
+                Review.objects.filter(user__in={review.user_id for review in reviews}, book__in={review.book_id for review in reviews})
+                .values_list('user_id', 'book_id')
+            )
+            kept = [review for review in reviews if (review.user_id, review.book_id) not in existing]
+            if len(kept) == len(reviews):
+                raise
+            report['skipped'] += len(reviews) - len(kept)
+            reviews = kept
+    return reviews
@@ -1,12 +1,68 @@
-from .kafka_producer import *
 import json
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
 from .models import *
 
-class BookSerializer(serializers.ModelSerializer):
+
+# ?fields=a,b keeps only the listed fields of GET responses, ?exclude=a,b drops them
+class SparseFieldsetMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return
+
+        fields = request.query_params.get('fields')
+        exclude = request.query_params.get('exclude')
+        for param, names in (('fields', fields), ('exclude', exclude)):
+            unknown = set(names.split(',')) - set(self.fields) if names else set()
+            if unknown:
+                raise serializers.ValidationError({param: f'Unknown fields: {", ".join(sorted(unknown))}.'})
+        if fields:
+            for name in set(self.fields) - set(fields.split(',')):
+                self.fields.pop(name)
+        if exclude:
+            for name in exclude.split(','):
+                self.fields.pop(name, None)
+
+    # Load only the columns behind the fields that will be rendered, related
+    # fields one level deep (source='book.title') are joined with select_related
+    @classmethod
+    def project_queryset(cls, queryset, request):
+        if request.method != 'GET':
+            return queryset
+
+        columns, related = [], []
+        for field in cls(context={'request': request}).fields.values():
+            path = field.source.split('.')
+            try:
+                model_field = queryset.model._meta.get_field(path[0])
+            except FieldDoesNotExist:
+                return queryset
+
+            if len(path) == 1:
+                columns.append(path[0])
+            elif len(path) == 2 and model_field.many_to_one:
+                related.append(path[0])
+                columns += [path[0], '__'.join(path)]
+            else:
+                return queryset
+
+        # Joins of the base queryset outside the projection would be deferred and traversed at once
+        queryset = queryset.select_related(None)
+        if related:
+            queryset = queryset.select_related(*related)
+        return queryset.only(*columns)
+
+
+class BookSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    rating_avg = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
+
     class Meta:
         model = Book
-        fields = '__all__'
+        exclude = ['search_vector']
+        read_only_fields = ['rating_count', 'rating_sum', 'rating_avg']
 
 
 class CustomerSerializer(serializers.ModelSerializer):
@@ -56,17 +112,22 @@ class CustomerSerializer(serializers.ModelSerializer):
         return customer
 
 
-class ReviewSerializer(serializers.ModelSerializer):
+class ReviewSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    book_title = serializers.CharField(source='book.title', read_only=True)
+    user_name = serializers.CharField(source='user.username', read_only=True)
+
     class Meta:
         model = Review
-        fields = ['id', 'book', 'user', 'rating', 'comment', 'created_at', 'updated_at']
+        fields = ['id', 'book', 'user', 'rating', 'comment', 'created_at', 'updated_at', 'book_title', 'user_name']
         read_only_fields = ['user', 'created_at', 'updated_at']
 
-    def to_representation(self, instance):
-        representation = super().to_representation(instance)
-        representation['book_title'] = instance.book.title  
-        representation['user_name'] = instance.user.username  
-        return representation
+
+# One row of a bulk review import. Users and books are checked for the whole batch at once
+class ReviewImportSerializer(serializers.Serializer):
+    user = serializers.IntegerField()
+    book = serializers.IntegerField()
+    rating = serializers.ChoiceField(choices=[i for i in range(1, 6)])
+    comment = serializers.CharField(allow_blank=True, required=False, default='')
 
 
 class CartSerializer(serializers.ModelSerializer):
@@ -75,16 +136,17 @@ class CartSerializer(serializers.ModelSerializer):
     book_title = serializers.CharField(source='book.title', read_only=True)
     book_price = serializers.DecimalField(source='book.price', max_digits=10, decimal_places=2, read_only=True, coerce_to_string=False)
     discount = serializers.DecimalField(source='book.discount', max_digits=5, decimal_places=2, read_only=True, coerce_to_string=False)  
+    # Annotated by the viewset queryset (cart_totals.with_line_totals), price with the book discount
     total_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True, coerce_to_string=False) 
     added_at = serializers.DateTimeField(read_only=True) 
+    # .values() path of customer for the fast list serializer, str(user) is the username
+    value_sources = {'customer': 'customer__user__username'}
+
     class Meta:
         model = Cart
         fields = ['id', 'customer', 'book_id', 'book_title', 'book_price', 'quantity', 'discount', 'total_price', 'added_at']
         read_only_fields = ['id', 'customer', 'book_title', 'book_price', 'discount', 'total_price', 'added_at', 'book_id'] 
 
-    def get_total_price(self, obj):
-        return (obj.book.price * obj.quantity) * (1 - obj.discount / 100)
-
     def validate_book_id(self, value):
         # Book must exist in database
         if not Book.objects.filter(id=value).exists():
@@ -98,7 +160,9 @@ class CartSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
     def to_representation(self, instance):
-        representation = super().to_representation(instance)
+        return self.finalize_representation(super().to_representation(instance))
+
+    def finalize_representation(self, representation):
         request = self.context.get('request')
 
         if request and not request.user.is_staff:
@@ -107,6 +171,18 @@ class CartSerializer(serializers.ModelSerializer):
         
         return representation
 
+# One line of a batch cart change: quantity sets the line (0 removes it), increment adds to it
+class CartBatchItemSerializer(serializers.Serializer):
+    book_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=0, required=False)
+    increment = serializers.IntegerField(min_value=1, required=False)
+
+    def validate(self, data):
+        if ('quantity' in data) == ('increment' in data):
+            raise serializers.ValidationError("Provide either quantity or increment.")
+        return data
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
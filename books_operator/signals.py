@@ -0,0 +1,28 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from .catalog_cache import invalidate_catalog
+from .models import Book, Review
+
+
+# Any saved or deleted book (API, admin, shell) makes cached catalog responses stale
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def invalidate_catalog_on_book_change(sender, **kwargs):
+    invalidate_catalog()
+
+
+# Reviews render the book title and the user name. Renaming either moves updated_at of their reviews,
+# so the review validators stay a plain MAX(updated_at) / COUNT over the review rows.
+# The UPDATE runs before the save and only touches reviews while the stored name still differs
+@receiver(pre_save, sender=Book)
+def touch_reviews_on_book_rename(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is not None and (update_fields is None or 'title' in update_fields):
+        Review.objects.filter(book_id=instance.pk).exclude(book__title=instance.title).update(updated_at=timezone.now())
+
+
+@receiver(pre_save, sender=User)
+def touch_reviews_on_user_rename(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is not None and (update_fields is None or 'username' in update_fields):
+        Review.objects.filter(user_id=instance.pk).exclude(user__username=instance.username).update(updated_at=timezone.now())
@@ -0,0 +1,41 @@
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from .catalog_cache import invalidate_catalog
+from .models import Book
+
+
+class OutOfStock(Exception):
+    def __init__(self, shortages):
+        super().__init__('Not enough stock.')
+        self.shortages = shortages
+
+
+# Take the ordered quantities ({book_id: quantity}) out of stock, inside the caller's transaction.
+# Book rows are locked in ascending id order, so concurrent checkouts over the same books wait
+# for each other instead of deadlocking, and the checked stock can't change before the UPDATE.
+# Returns the locked books by id, raises OutOfStock when any of them is short
+def reserve_stock(quantities):
+    books = {book.id: book for book in Book.objects.select_for_update().filter(id__in=quantities).order_by('id')}
+
+    shortages = [
+        {
+            'book_id': book_id,
+            'title': books[book_id].title if book_id in books else None,
+            'requested': quantity,
+            'available': books[book_id].stock if book_id in books else 0,
+        }
+        for book_id, quantity in quantities.items()
+        if book_id not in books or books[book_id].stock < quantity
+    ]
+    if shortages:
+        raise OutOfStock(shortages)
+
+    Book.objects.filter(id__in=quantities).update(
+        stock=F('stock') - Case(*[When(id=book_id, then=Value(quantity)) for book_id, quantity in quantities.items()]),
+        updated_at=timezone.now(),
+    )
+    invalidate_catalog()
+
+    for book_id, quantity in quantities.items():
+        books[book_id].stock -= quantity
+    return books
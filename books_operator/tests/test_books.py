@@ -1,13 +1,24 @@
+from datetime import timedelta
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase, APIClient
 from rest_framework_simplejwt.tokens import AccessToken
 from books_operator.models import User, Book 
+from books_operator.serializers import BookSerializer
+from books_operator.catalog_cache import check_catalog_backend
 
 
 class BookTests(APITestCase):
     
     def setUp(self):
+        caches['catalog'].clear()
+
         self.user = User.objects.create_user(username='testuser', password='password')
         self.admin_user = User.objects.create_superuser(username='adminuser', password='password')
 
@@ -111,12 +122,12 @@ class BookTests(APITestCase):
 
         response = self.client.get(url, {'genre': 'Fantasy'})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
     
         response = self.client.get(url, {'genre': 'Fiction'})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['genre'], 'Science Fiction')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['genre'], 'Science Fiction')
 
     def test_filter_books_by_author(self):
         Book.objects.create(**self.book_data)
@@ -126,13 +137,13 @@ class BookTests(APITestCase):
 
         response = self.client.get(url, {'author': 'Test Author'})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['author'], 'Test Author')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['author'], 'Test Author')
     
         response = self.client.get(url, {'author': 'Test'}) 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['author'], 'Test Author')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['author'], 'Test Author')
 
     def test_filter_books_by_title(self):
         Book.objects.create(**self.book_data)
@@ -142,12 +153,223 @@ class BookTests(APITestCase):
 
         response = self.client.get(url, {'title': 'Test Book'})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['title'], 'Test Book')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['title'], 'Test Book')
     
         response = self.client.get(url, {'title': 'Test'})   
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['title'], 'Test Book')
+
+    def test_full_text_search_books(self):
+        Book.objects.create(**self.book_data)
+        Book.objects.create(**self.book_data_1)
+        Book.objects.create(**{**self.book_data_1, 'title': 'Galaxy Atlas', 'author': 'Another Author'})
+
+        url = reverse('books-search')
+
+        response = self.client.get(url, {'q': 'galaxy'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['title'], 'Galaxy Atlas')
+
+        # Title matches rank above author-only matches
+        response = self.client.get(url, {'q': 'another'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([book['title'] for book in response.data['results']], ['Another Book', 'Galaxy Atlas'])
+        self.assertNotIn('search_vector', response.data['results'][0])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400)
+
+    def test_autocomplete_books(self):
+        Book.objects.create(**self.book_data)
+        Book.objects.create(**self.book_data_1)
+        Book.objects.create(**{**self.book_data, 'title': 'Harry Potter', 'author': 'J. K. Rowling'})
+
+        url = reverse('books-autocomplete')
+
+        # Typo in the prefix still matches
+        response = self.client.get(url, {'q': 'Hary Pott'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]['title'], 'Harry Potter')
+        self.assertEqual(set(response.data[0]), {'id', 'title', 'author'})
+
+        response = self.client.get(url, {'q': 'Rowlin'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([book['author'] for book in response.data], ['J. K. Rowling'])
+
+        response = self.client.get(url, {'q': 'Book', 'limit': 1})
         self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['title'], 'Test Book')
 
- 
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400)
+
+    def test_books_list_cursor_pagination(self):
+        for i in range(5):
+            Book.objects.create(**{**self.book_data, 'title': f'Book {i}'})
+
+        response = self.client.get(reverse('books-list'), {'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        titles = [book['title'] for book in response.data['results']]
+        self.assertIsNone(response.data['previous'])
+
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            titles += [book['title'] for book in response.data['results']]
+
+        self.assertEqual(titles, [f'Book {i}' for i in range(5)])
+
+    def test_books_sorted_by_price_pagination(self):
+        cheap = Book.objects.create(**{**self.book_data, 'title': 'Cheap', 'price': '5.00'})
+        tied = [Book.objects.create(**{**self.book_data, 'title': f'Tied {i}'}) for i in range(4)]
+        rare = Book.objects.create(**{**self.book_data, 'title': 'Rare', 'price': '50.00'})
+
+        response = self.client.get(reverse('books-list'), {'ordering': '-price', 'page_size': 2})
+        ids = [book['id'] for book in response.data['results']]
+        while response.data['next']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(response.data['next'])
+            ids += [book['id'] for book in response.data['results']]
+            # Books sharing a price are paged by id, not skipped over with an OFFSET
+            self.assertFalse(any('OFFSET' in query['sql'] for query in queries.captured_queries))
+
+        self.assertEqual(ids, [rare.id] + [book.id for book in reversed(tied)] + [cheap.id])
+
+        response = self.client.get(reverse('books-list'), {'ordering': 'title'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_ranked_search_pagination(self):
+        for i in range(3):
+            Book.objects.create(**{**self.book_data, 'title': f'Dragon {i}', 'author': 'Dragon Writer'})
+        Book.objects.create(**{**self.book_data, 'title': 'Dragon Dragon'})
+
+        response = self.client.get(reverse('books-search'), {'q': 'dragon', 'page_size': 1})
+        titles = [book['title'] for book in response.data['results']]
+        while response.data['next']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(response.data['next'])
+            titles += [book['title'] for book in response.data['results']]
+            # The three tied ranks are paged by id, not skipped over with an OFFSET
+            self.assertFalse(any('OFFSET' in query['sql'] for query in queries.captured_queries))
+
+        self.assertEqual(titles, ['Dragon Dragon', 'Dragon 0', 'Dragon 1', 'Dragon 2'])
+
+    def test_filter_books_with_facets(self):
+        Book.objects.create(**self.book_data)
+        Book.objects.create(**self.book_data_1)
+        Book.objects.create(**{**self.book_data_1, 'title': 'Cheap Book', 'price': '5.00', 'discount': '0.00', 'stock': 0})
+        Book.objects.create(**{**self.book_data_1, 'title': 'Rare Book', 'price': '150.00'})
+
+        url = reverse('books-filter')
+
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        facets = response.data['facets']
+        self.assertEqual(facets['genre'], {'Test genre': 1, 'Science Fiction': 3})
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [1, 1, 1, 0, 1])
+        self.assertEqual(facets['in_stock'], 3)
+
+        response = self.client.get(url, {'genre': 'Science Fiction', 'in_stock': 'true', 'max_price': '100'})
+        self.assertEqual([book['title'] for book in response.data['results']], ['Another Book'])
+        self.assertEqual(response.data['facets']['genre'], {'Science Fiction': 1})
+
+        response = self.client.get(url, {'discounted': '1', 'min_price': '30'})
+        self.assertEqual([book['title'] for book in response.data['results']], ['Rare Book'])
+
+        response = self.client.get(url, {'min_price': 'cheap'})
+        self.assertEqual(response.status_code, 400)
+
+        for price in ('NaN', 'sNaN', 'Infinity', '-inf'):
+            response = self.client.get(url, {'min_price': price})
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get(url, {'max_price': price})
+            self.assertEqual(response.status_code, 400)
+
+    def test_process_local_catalog_cache_is_refused(self):
+        local = {'catalog': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=local):
+            with self.assertRaises(ImproperlyConfigured):
+                check_catalog_backend()
+        with override_settings(CACHES=local, CATALOG_CACHE_ALLOW_LOCAL=True):
+            check_catalog_backend()
+        check_catalog_backend()
+
+    def test_catalog_responses_cached_until_book_changes(self):
+        book = Book.objects.create(**self.book_data)
+        url = reverse('books-list')
+
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.data['results'][0]['title'], 'Test Book')
+
+        self.api_authentication(self.admin_token)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(reverse('books-detail', args=[book.id]), {'stock': 3}, format='json')
+
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['stock'], 3)
+
+        response = self.client.get(reverse('books-cache-stats'))
+        self.assertEqual((response.data['hits'], response.data['misses']), (1, 2))
+
+        self.api_authentication(self.user_token)
+        response = self.client.get(reverse('books-cache-stats'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_book_conditional_get(self):
+        book = Book.objects.create(**self.book_data)
+        url = reverse('books-detail', args=[book.id])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(reverse('books-list'))
+        last_modified = response['Last-Modified']
+        response = self.client.get(reverse('books-list'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            book.title = 'Renamed'
+            book.save()
+        Book.objects.filter(id=book.id).update(updated_at=book.updated_at + timedelta(seconds=5))
+        response = self.client.get(reverse('books-list'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+    def test_sparse_fieldsets(self):
+        book = Book.objects.create(**self.book_data)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('books-list'), {'fields': 'id,title,price'})
+        self.assertEqual(list(response.data['results'][0]), ['id', 'title', 'price'])
+        self.assertFalse(any('"description"' in query['sql'] for query in queries))
+
+        response = self.client.get(reverse('books-by-author'), {'author': 'Test', 'exclude': 'description,synopsis'})
+        self.assertNotIn('description', response.data['results'][0])
+        self.assertNotIn('synopsis', response.data['results'][0])
+        self.assertIn('title', response.data['results'][0])
+
+        response = self.client.get(reverse('books-list'), {'fields': 'id,nope'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('nope', str(response.data['fields']))
+        response = self.client.get(reverse('books-detail', args=[book.id]), {'exclude': 'descripton'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_book_list_matches_serializer_output(self):
+        Book.objects.create(**self.book_data)
+        Book.objects.create(**{**self.book_data_1, 'title': None, 'rating_count': 3, 'rating_sum': 11})
+
+        response = self.client.get(reverse('books-list'))
+
+        expected = BookSerializer(Book.objects.order_by('id'), many=True).data
+        self.assertEqual(JSONRenderer().render(response.data['results']), JSONRenderer().render(expected))
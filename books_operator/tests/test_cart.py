@@ -1,9 +1,26 @@
+import io
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from django.db import connection
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
-from books_operator.models import User, Cart, Customer, Book
+from rest_framework.renderers import JSONRenderer
+from books_operator.models import User, Cart, Customer, Book, Order
+from books_operator.serializers import CartSerializer
+from books_operator.views import CartViewSet
+from books_operator.cart_totals import with_line_totals
+from books_operator.cart_store import CacheCartStore, CartLockTimeout, get_cart_store
 
 
 class CartTestCase(APITestCase):
@@ -39,10 +56,10 @@ class CartTestCase(APITestCase):
 
         response = self.client.get(reverse("cart-list"))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
-        cart_item1 = response.data[0]
-        cart_item2 = response.data[1]
+        cart_item1 = response.data['results'][0]
+        cart_item2 = response.data['results'][1]
         self.assertEqual(cart_item1["book_title"], "Book 1")
         self.assertEqual(cart_item1["quantity"], 1)
         self.assertEqual(cart_item2["book_title"], "Book 2")
@@ -81,7 +98,7 @@ class CartTestCase(APITestCase):
         
         response = self.client.get(reverse("cart-user-cart", kwargs={"user_id": self.customer.id}))
         self.assertEqual(response.status_code, status.HTTP_200_OK)  
-        self.assertEqual(response.data[0]["book_title"], "Book 1")
+        self.assertEqual(response.data['results'][0]["book_title"], "Book 1")
 
     def test_discount_and_price_update_on_cart_view(self):
         self.api_authentication(self.user_token)
@@ -92,7 +109,7 @@ class CartTestCase(APITestCase):
         response = self.client.get(reverse("cart-list"))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         
-        cart_item_data = response.data[0]
+        cart_item_data = response.data['results'][0]
         self.assertEqual(cart_item_data["discount"], self.book1.discount)
         self.assertEqual(cart_item_data["book_price"], self.book1.price)
 
@@ -101,4 +118,272 @@ class CartTestCase(APITestCase):
         
         response = self.client.patch(self.cart_url, data={"quantity": 5}, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data["quantity"], 5) 
+        self.assertEqual(response.data["quantity"], 5)
+        # 5 x 100.00 with a 10% discount, not the total of the old quantity
+        self.assertEqual(response.data["total_price"], Decimal("450.00"))
+
+    def test_cart_list_matches_serializer_output(self):
+        Cart.objects.create(customer=self.customer, book=self.book2, quantity=3)
+
+        for token, is_staff in ((self.user_token, False), (self.admin_token, True)):
+            self.api_authentication(token)
+            response = self.client.get(reverse("cart-list"))
+
+            request = response.wsgi_request
+            request.user = self.admin_user if is_staff else self.user
+            queryset = with_line_totals(Cart.objects.all() if is_staff else Cart.objects.filter(customer=self.customer))
+            expected = CartSerializer(queryset.order_by('id'), many=True, context={'request': request}).data
+            self.assertEqual(JSONRenderer().render(response.data['results']), JSONRenderer().render(expected))
+
+    def test_cart_summary(self):
+        Cart.objects.create(customer=self.customer, book=self.book2, quantity=3)
+        Cart.objects.create(customer=self.admin_customer, book=self.book2, quantity=5)
+        self.api_authentication(self.user_token)
+
+        # User lookup and the cart with its totals
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("cart-summary"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item["total_price"] for item in response.data["items"]], [Decimal("90.00"), Decimal("480.00")])
+        self.assertEqual(response.data["quantity"], 4)
+        self.assertEqual(response.data["subtotal"], Decimal("700.00"))
+        self.assertEqual(response.data["discount"], Decimal("130.00"))
+        self.assertEqual(response.data["total"], Decimal("570.00"))
+
+        # List rows carry the same line total
+        response = self.client.get(reverse("cart-list"))
+        self.assertEqual([item["total_price"] for item in response.data["results"]], [90.0, 480.0])
+
+        Cart.objects.filter(customer=self.customer).delete()
+        response = self.client.get(reverse("cart-summary"))
+        self.assertEqual((response.data["items"], response.data["total"]), ([], Decimal("0.00")))
+
+    def test_cart_batch(self):
+        book3 = Book.objects.create(title="Book 3", price=50)
+        book4 = Book.objects.create(title="Book 4", price=10)
+        Cart.objects.create(customer=self.customer, book=self.book2, quantity=2)
+        Cart.objects.create(customer=self.customer, book=book3, quantity=1)
+        self.api_authentication(self.user_token)
+
+        # User, books and customer lookups, delete, upsert, increment insert and update, summary
+        with self.assertNumQueries(10):
+            response = self.client.post(reverse("cart-batch"), [
+                {"book_id": self.book1.id, "quantity": 4},
+                {"book_id": self.book2.id, "increment": 3},
+                {"book_id": book3.id, "quantity": 0},
+                {"book_id": book4.id, "increment": 2},
+            ], format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        quantities = dict(Cart.objects.filter(customer=self.customer).values_list("book_id", "quantity"))
+        self.assertEqual(quantities, {self.book1.id: 4, self.book2.id: 5, book4.id: 2})
+        self.assertEqual([item["book_id"] for item in response.data["items"]], [self.book1.id, self.book2.id, book4.id])
+        self.assertEqual(response.data["total"], Decimal("1180.00"))
+
+        # Nothing is applied when a line is invalid
+        response = self.client.post(reverse("cart-batch"), [
+            {"book_id": self.book1.id, "quantity": 1},
+            {"book_id": 0, "quantity": 1},
+        ], format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse("cart-batch"), [{"book_id": self.book1.id, "quantity": 1, "increment": 1}], format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Cart.objects.get(customer=self.customer, book=self.book1).quantity, 4)
+
+        self.api_authentication(self.admin_token)
+        response = self.client.post(reverse("cart-batch"), [], format="json")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_sweep_abandoned_carts(self):
+        fresh = Cart.objects.create(customer=self.customer, book=self.book2, quantity=1)
+        old = Cart.objects.create(customer=self.admin_customer, book=self.book2, quantity=1)
+        Cart.objects.filter(id__in=[self.cart_item.id, old.id]).update(added_at=timezone.now() - timedelta(days=31))
+
+        out = io.StringIO()
+        call_command("sweep_abandoned_carts", chunk_size=1, stdout=out)
+        self.assertIn("Deleted 2 abandoned cart lines older than 30 days.", out.getvalue())
+        self.assertEqual(list(Cart.objects.values_list("id", flat=True)), [fresh.id])
+
+
+@override_settings(CART_STORAGE='cache', CART_CACHE_ALLOW_LOCAL=True)
+class CacheCartStoreTestCase(APITestCase):
+
+    def setUp(self):
+        caches['carts'].clear()
+
+        self.user = User.objects.create_user(username="user", password="password")
+        self.customer = Customer.objects.create(user=self.user, phone_number="1234567890")
+        self.book1 = Book.objects.create(title="Book 1", price=100, discount=10, stock=10)
+        self.book2 = Book.objects.create(title="Book 2", price=200, stock=10)
+        Cart.objects.create(customer=self.customer, book=self.book1, quantity=1)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def test_adds_stay_in_cache_until_flushed(self):
+        self.client.post(reverse("cart-list"), {"book_id": self.book1.id})
+        # User, customer and book lookups only, the cart is already loaded
+        with self.assertNumQueries(3):
+            response = self.client.post(reverse("cart-list"), {"book_id": self.book2.id})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data["book_title"], response.data["quantity"]), ("Book 2", 1))
+        self.assertEqual(dict(Cart.objects.values_list("book_id", "quantity")), {self.book1.id: 1})
+
+        out = io.StringIO()
+        call_command("flush_cart_store", stdout=out)
+        self.assertIn("Flushed 1 carts.", out.getvalue())
+        self.assertEqual(dict(Cart.objects.values_list("book_id", "quantity")), {self.book1.id: 2, self.book2.id: 1})
+
+    def test_cart_routes_read_flushed_lines(self):
+        self.client.post(reverse("cart-list"), {"book_id": self.book2.id})
+        self.client.post(reverse("cart-list"), {"book_id": self.book2.id})
+
+        response = self.client.get(reverse("cart-summary"))
+        self.assertEqual([item["quantity"] for item in response.data["items"]], [1, 2])
+        self.assertEqual(response.data["total"], Decimal("490.00"))
+
+        # A change through the Cart table is seen by the next cached add
+        line = Cart.objects.get(book=self.book2)
+        self.client.patch(reverse("cart-detail", args=[line.id]), {"quantity": 5}, format="json")
+        response = self.client.post(reverse("cart-list"), {"book_id": self.book2.id})
+        self.assertEqual(response.data["quantity"], 6)
+
+        self.client.delete(reverse("cart-clear-cart"))
+        response = self.client.get(reverse("cart-list"))
+        self.assertEqual(response.data["results"], [])
+
+    def test_add_response_matches_database_store(self):
+        book = Book.objects.create(title="Book 3", price=Decimal("19.99"), discount=Decimal("12.50"), stock=10)
+        response = self.client.post(reverse("cart-list"), {"book_id": book.id})
+        response = self.client.post(reverse("cart-list"), {"book_id": book.id})
+
+        with override_settings(CART_STORAGE="database"):
+            Cart.objects.create(customer=self.customer, book=book, quantity=2)
+            expected = self.client.post(reverse("cart-list"), {"book_id": self.book2.id}).data.keys()
+            line = with_line_totals(Cart.objects.filter(customer=self.customer, book=book)).get()
+        self.assertEqual(response.data.keys(), expected)
+        self.assertEqual(response.data["total_price"], line.total_price)
+        self.assertEqual(response.data["total_price"], Decimal("34.98"))
+
+    def test_cart_table_writes_hold_the_cart_lock(self):
+        line = Cart.objects.get(book=self.book1)
+        lock_held = []
+        update_quantity = CartViewSet.update_quantity
+
+        def locked_update_quantity(view, cart_item, quantity):
+            lock_held.append(caches['carts'].get(f'cart:{self.customer.id}:lock') is not None)
+            return update_quantity(view, cart_item, quantity)
+
+        with mock.patch.object(CartViewSet, 'update_quantity', locked_update_quantity):
+            response = self.client.patch(reverse("cart-detail", args=[line.id]), {"quantity": 4}, format="json")
+        self.assertEqual(response.data["quantity"], 4)
+        self.assertEqual(lock_held, [True])
+        self.assertIsNone(caches['carts'].get(f'cart:{self.customer.id}:lock'))
+
+    def test_cart_reads_flush_without_holding_the_lock(self):
+        self.client.post(reverse("cart-list"), {"book_id": self.book2.id})
+        lock_held = []
+        summary = CartViewSet.summary
+
+        def unlocked_summary(view, request):
+            lock_held.append(caches['carts'].get(f'cart:{self.customer.id}:lock') is not None)
+            return summary(view, request)
+
+        with mock.patch.object(CacheCartStore, 'renewed') as renewed, mock.patch.object(CartViewSet, 'summary', unlocked_summary):
+            response = self.client.get(reverse("cart-summary"))
+            self.assertEqual([item["book_id"] for item in response.data["items"]], [self.book1.id, self.book2.id])
+            response = self.client.get(reverse("cart-list"))
+            self.assertEqual(len(response.data["results"]), 2)
+        self.assertEqual(lock_held, [False])
+        renewed.assert_not_called()
+
+    def test_admin_flushes_only_the_viewed_cart(self):
+        other = Customer.objects.create(user=User.objects.create_user(username="other", password="password"), phone_number="1234567892")
+        get_cart_store().increment(self.customer.id, self.book2.id)
+        get_cart_store().increment(other.id, self.book2.id)
+        admin = User.objects.create_user(username="admin", password="password", is_staff=True)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(admin)}")
+
+        self.client.get(reverse("cart-list"))
+        self.assertFalse(Cart.objects.filter(book=self.book2).exists())
+
+        response = self.client.get(reverse("cart-user-cart", args=[other.id]))
+        self.assertEqual([item["book_id"] for item in response.data["results"]], [self.book2.id])
+        self.assertEqual(list(Cart.objects.filter(book=self.book2).values_list("customer_id", flat=True)), [other.id])
+
+    def test_cache_that_loses_carts_is_refused(self):
+        with override_settings(CART_CACHE_ALLOW_LOCAL=False):
+            with self.assertRaises(ImproperlyConfigured):
+                get_cart_store()
+        with override_settings(CART_CACHE_MAX_ENTRIES=caches['carts']._max_entries + 1):
+            with self.assertRaises(ImproperlyConfigured):
+                get_cart_store()
+
+    def test_checkout_lock_outlives_its_timeout(self):
+        store = get_cart_store()
+        with mock.patch('books_operator.cart_store.LOCK_TIMEOUT', 0.3):
+            with store.synced(self.customer.id):
+                time.sleep(1)
+                with self.assertRaises(CartLockTimeout):
+                    store.increment(self.customer.id, self.book2.id)
+            self.assertTrue(store.increment(self.customer.id, self.book2.id))
+
+    def test_checkout_reads_cached_cart(self):
+        self.client.post(reverse("cart-list"), {"book_id": self.book2.id})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("orders-create-order"))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        order = Order.objects.get()
+        self.assertEqual(sorted(order.items.values_list("book_id", flat=True)), [self.book1.id, self.book2.id])
+        self.assertFalse(Cart.objects.exists())
+
+        # The cart was emptied by the order, not resurrected from the cache
+        response = self.client.post(reverse("cart-list"), {"book_id": self.book2.id})
+        self.assertEqual(response.data["quantity"], 1)
+        call_command("flush_cart_store", stdout=io.StringIO())
+        self.assertEqual(dict(Cart.objects.values_list("book_id", "quantity")), {self.book2.id: 1})
+
+
+class CartConcurrencyTest(TransactionTestCase):
+    THREADS = 20
+    ADDS_PER_THREAD = 10
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", password="password")
+        self.customer = Customer.objects.create(user=self.user, phone_number="1234567890")
+        self.book = Book.objects.create(title="Hot Book", price=100)
+        self.token = str(AccessToken.for_user(self.user))
+
+    def test_concurrent_adds_keep_every_increment(self):
+        barrier = threading.Barrier(self.THREADS)
+        statuses, errors = [], []
+
+        def add_to_cart():
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+            try:
+                # All threads race for the first insert of the line
+                barrier.wait()
+                for _ in range(self.ADDS_PER_THREAD):
+                    statuses.append(client.post(reverse("cart-list"), {"book_id": self.book.id}).status_code)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add_to_cart) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        call_command("flush_cart_store", stdout=io.StringIO())
+        self.assertEqual(statuses.count(status.HTTP_201_CREATED), 1)
+        self.assertEqual(statuses.count(status.HTTP_200_OK), self.THREADS * self.ADDS_PER_THREAD - 1)
+        cart_item = Cart.objects.get(customer=self.customer, book=self.book)
+        self.assertEqual(cart_item.quantity, self.THREADS * self.ADDS_PER_THREAD)
+
+    @override_settings(CART_STORAGE='cache', CART_CACHE_ALLOW_LOCAL=True)
+    def test_concurrent_adds_keep_every_increment_in_cache_store(self):
+        caches['carts'].clear()
+        self.test_concurrent_adds_keep_every_increment()
@@ -2,7 +2,8 @@ from django.urls import reverse
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework.test import APITestCase
 from rest_framework import status
-from books_operator.models import User, Customer
+from books_operator.models import User, Customer, IdempotencyKey, OutboxEvent
+from books_operator.event_schemas import decode_event, encode_event
 
 class CustomerViewSetTest(APITestCase):
     
@@ -67,16 +68,16 @@ class CustomerViewSetTest(APITestCase):
 
         response = self.client.get(self.profile_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data[0]['username'], self.regular_user.username)
-        self.assertEqual(response.data[0]['phone_number'], self.regular_customer.phone_number)
+        self.assertEqual(response.data['results'][0]['username'], self.regular_user.username)
+        self.assertEqual(response.data['results'][0]['phone_number'], self.regular_customer.phone_number)
 
     def test_get_profile_as_admin(self):
         self.api_authentication(self.admin_token)
 
         response = self.client.get(self.profile_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertIsInstance(response.data, list)
-        self.assertEqual(len(response.data), Customer.objects.count())
+        self.assertIsInstance(response.data['results'], list)
+        self.assertEqual(len(response.data['results']), Customer.objects.count())
 
     def test_update_profile_as_regular_user(self):
         self.api_authentication(self.regular_token)
@@ -99,6 +100,17 @@ class CustomerViewSetTest(APITestCase):
         self.regular_customer.refresh_from_db()
         self.assertEqual(self.regular_customer.phone_number, '9876543211')
 
+    def test_full_update_writes_outbox_event(self):
+        self.api_authentication(self.regular_token)
+
+        url = reverse('customer-detail', args=[self.regular_customer.id])
+        response = self.client.put(url, {'phone_number': '9876543212', 'user': self.regular_user.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        event = OutboxEvent.objects.get(topic='customer_topic')
+        self.assertEqual((event.key, event.payload['username'], event.payload['phone_number']), (str(self.regular_customer.id), 'user', '9876543212'))
+        self.assertEqual(decode_event(event.topic, encode_event(event.topic, event.payload)), event.payload)
+
     def test_create_customer_while_logged_in(self):
         self.api_authentication(self.regular_token)
 
@@ -128,3 +140,29 @@ class CustomerViewSetTest(APITestCase):
         self.assertFalse(Customer.objects.filter(id=self.regular_customer.id).exists())
         self.assertFalse(User.objects.filter(id=self.regular_user.id).exists())  
 
+    def test_create_customer_with_idempotency_key(self):
+        data = {'username': 'new_user', 'password': 'newpass', 'phone_number': '5550001111'}
+        url = reverse('customer-list')
+
+        response = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-1')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # The retry gets the first response back instead of a duplicate username error
+        retry = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-1')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data, response.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(User.objects.filter(username='new_user').count(), 1)
+
+        response = self.client.post(url, {**data, 'phone_number': '5550002222'}, HTTP_IDEMPOTENCY_KEY='signup-1')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        # Failed requests are not stored, the client can fix them and retry with the same key
+        response = self.client.post(url, {'username': 'other_user'}, HTTP_IDEMPOTENCY_KEY='signup-2')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(IdempotencyKey.objects.filter(key='signup-2').exists())
+
+        # Another anonymous client reusing the key doesn't get the stored response
+        response = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-1', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn('Idempotent-Replayed', response)
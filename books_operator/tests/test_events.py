@@ -0,0 +1,136 @@
+import base64
+import io
+import json
+import os
+import tempfile
+import time
+from unittest import mock
+import msgpack
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from books_operator.event_schemas import HEADER, SchemaError, decode_event, encode_event
+from books_operator.event_transport import FileTransport, get_event_transport
+from books_operator.kafka_producer import ProducerService, send_messages
+
+
+# No broker is needed: nothing is delivered, messages only wait in the local queue
+class ProducerServiceTests(SimpleTestCase):
+
+    def make_service(self, **kwargs):
+        service = ProducerService({'bootstrap.servers': 'localhost:1', 'queue.buffering.max.messages': 2}, **kwargs)
+        self.addCleanup(service.close, 0)
+        return service
+
+    def test_produce_does_not_wait_for_delivery(self):
+        service = self.make_service()
+        self.assertTrue(service.produce('order_topic', b'{}', key='1'))
+        stats = service.stats()
+        self.assertEqual((stats['queued'], stats['delivered'], stats['failed']), (1, 0, 0))
+        self.assertGreaterEqual(stats['in_flight'], 1)
+
+    def test_full_queue_drops_messages(self):
+        service = self.make_service(backpressure='drop')
+        results = [service.produce('order_topic', b'{}') for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual((service.stats()['queued'], service.stats()['dropped']), (2, 1))
+
+    def test_full_queue_raises(self):
+        service = self.make_service(backpressure='raise')
+        service.produce('order_topic', b'{}')
+        service.produce('order_topic', b'{}')
+        with self.assertRaises(BufferError):
+            service.produce('order_topic', b'{}')
+
+    def test_full_queue_blocks_until_timeout(self):
+        service = self.make_service(backpressure='block', block_timeout=0.2)
+        service.produce('order_topic', b'{}')
+        service.produce('order_topic', b'{}')
+        with self.assertRaises(BufferError):
+            service.produce('order_topic', b'{}')
+        self.assertEqual(service.stats()['queued'], 2)
+
+    def test_send_messages_waits_at_most_the_timeout(self):
+        service = self.make_service()
+        started = time.monotonic()
+        with mock.patch('books_operator.kafka_producer.get_producer_service', return_value=service):
+            failed = send_messages([('order_topic', '1', b'{}'), ('order_topic', '2', b'{}')], timeout=0.5)
+        self.assertEqual(failed, {0, 1})
+        self.assertLess(time.monotonic() - started, 0.9)
+
+
+class EventTransportTests(SimpleTestCase):
+
+    def test_file_transport_appends_ndjson(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.ndjson')
+            transport = FileTransport(path)
+            transport.send('order_topic', '1', '{"order_id": 1}')
+            self.assertEqual(transport.send_batch([('order_topic', '2', '{"order_id": 2}'), ('customer_topic', '3', b'\x81')]), set())
+
+            with open(path) as file:
+                lines = [json.loads(line) for line in file]
+        self.assertEqual(lines[0], {'topic': 'order_topic', 'key': '1', 'value': '{"order_id": 1}'})
+        self.assertEqual(base64.b64decode(lines[2]['value_b64']), b'\x81')
+        self.assertEqual(len(lines), 3)
+
+    @override_settings(EVENT_TRANSPORT='memory')
+    def test_transport_is_chosen_by_settings(self):
+        transport = get_event_transport()
+        self.assertIs(get_event_transport(), transport)
+        transport.clear()
+        transport.send('order_topic', '1', '{}')
+        self.assertEqual(transport.messages, [('order_topic', '1', '{}')])
+
+    def test_bench_event_transport(self):
+        out = io.StringIO()
+        call_command('bench_event_transport', events=200, batch_size=50, transports=['memory', 'file'], stdout=out)
+        self.assertIn('memory: 200 events', out.getvalue())
+        self.assertIn('file: 200 events', out.getvalue())
+
+
+@override_settings(EVENT_ENCODINGS={'order_topic': 'msgpack', 'customer_topic': 'msgpack'})
+class EventEncodingTests(SimpleTestCase):
+    order_event = {
+        'order_action': 'create', 'order_id': 7, 'customer_id': None, 'status': 'pending',
+        'total_price': '39.98', 'created_at': '2024-05-01T10:00:00.123456+00:00', 'updated_at': '2024-05-01T10:00:01+00:00',
+    }
+
+    def test_msgpack_round_trip(self):
+        value = encode_event('order_topic', self.order_event)
+        self.assertEqual(HEADER.unpack_from(value), (0, 1))
+        self.assertLess(len(value), len(json.dumps(self.order_event)) / 2)
+        self.assertEqual(decode_event('order_topic', value), self.order_event)
+
+    def test_json_unless_the_topic_opts_in(self):
+        with override_settings(EVENT_ENCODINGS={}):
+            value = encode_event('order_topic', self.order_event)
+        self.assertEqual(json.loads(value), self.order_event)
+        self.assertEqual(decode_event('order_topic', value), self.order_event)
+        # Topics without a schema stay JSON
+        with override_settings(EVENT_DEFAULT_ENCODING='msgpack'):
+            self.assertEqual(encode_event('unknown_topic', {'a': 1}), '{"a": 1}')
+
+    def test_fields_outside_the_schema_are_rejected(self):
+        with self.assertRaises(SchemaError):
+            encode_event('order_topic', {**self.order_event, 'note': 'gift'})
+
+    def test_old_versions_stay_decodable(self):
+        schemas = {'customer_topic': [
+            {'version': 1, 'fields': [{'name': 'customer_id', 'type': 'int'}]},
+            {'version': 2, 'fields': [{'name': 'customer_id', 'type': 'int'}, {'name': 'spent_money', 'type': 'decimal'}]},
+        ]}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'schemas.json')
+            with open(path, 'w') as file:
+                json.dump(schemas, file)
+            with override_settings(EVENT_SCHEMA_PATH=path):
+                value = encode_event('customer_topic', {'customer_id': 3, 'spent_money': '10.00'})
+                self.assertEqual(HEADER.unpack_from(value), (0, 2))
+                self.assertEqual(decode_event('customer_topic', value), {'customer_id': 3, 'spent_money': '10.00'})
+                # An event written with version 1 before version 2 was added
+                self.assertEqual(decode_event('customer_topic', HEADER.pack(0, 1) + msgpack.packb([3])), {'customer_id': 3})
+
+    def test_bench_event_encoding(self):
+        out = io.StringIO()
+        call_command('bench_event_encoding', events=100, repeat=1, stdout=out)
+        self.assertIn('order_topic msgpack', out.getvalue())
@@ -1,8 +1,24 @@
+from decimal import Decimal
+from unittest import mock
+import io
+import threading
+import time
+from datetime import timedelta
+from django.core.management import call_command
+from django.utils import timezone
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 from rest_framework_simplejwt.tokens import AccessToken
-from books_operator.models import User, Customer, Order, OrderItem, Cart, Book
+from rest_framework.renderers import JSONRenderer
+from books_operator.models import User, Customer, Order, OrderItem, Cart, Book, IdempotencyKey, OutboxEvent
+from books_operator.serializers import OrderSerializer
+from books_operator.outbox import enqueue_event, relay_batch
+from books_operator.event_schemas import HEADER, decode_event, encode_event
+from books_operator.event_transport import get_event_transport
 
 class OrderViewSetTests(APITestCase):
     def setUp(self):
@@ -11,7 +27,7 @@ class OrderViewSetTests(APITestCase):
         self.customer = Customer.objects.create(user=self.user, phone_number='1234567890')
         self.admin_customer = Customer.objects.create(user=self.admin_user, phone_number='1234567891')
 
-        self.book = Book.objects.create(title='Sample Book', price=10.00)
+        self.book = Book.objects.create(title='Sample Book', price=10.00, stock=10)
         self.cart_item = Cart.objects.create(customer=self.customer, book=self.book, quantity=1)
 
         # Создаем заказ для теста
@@ -37,16 +53,16 @@ class OrderViewSetTests(APITestCase):
 
         response = self.client.get(self.order_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)   
-        self.assertEqual(response.data[0]['id'], self.order.id)   
+        self.assertEqual(len(response.data['results']), 1)   
+        self.assertEqual(response.data['results'][0]['id'], self.order.id)   
 
     def test_admin_can_view_all_orders(self):
         self.api_authentication(self.admin_token)
 
         response = self.client.get(self.order_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)   
-        self.assertEqual(response.data[0]['id'], self.order.id)   
+        self.assertEqual(len(response.data['results']), 1)   
+        self.assertEqual(response.data['results'][0]['id'], self.order.id)   
 
     def test_user_can_create_order_from_cart(self):
         self.api_authentication(self.user_token)
@@ -100,22 +116,365 @@ class OrderViewSetTests(APITestCase):
         # Filter orders by customer ID for admin
         response = self.client.get(f"{self.order_url}?customer_id={self.customer.id}")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 3) 
+        self.assertEqual(len(response.data['results']), 3) 
 
         # Filters orders by status for admin
         response = self.client.get(f"{self.order_url}?status=pending")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 3)  
+        self.assertEqual(len(response.data['results']), 3)  
 
         # Filters orders by customer ID and status 
         response = self.client.get(f"{self.order_url}?customer_id={self.customer.id}&status=pending")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
         # Filter orders by status for user
         self.api_authentication(self.user_token)
 
         response = self.client.get(f"{self.order_url}?status=shipped")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        for order in response.data:
-            self.assertEqual(order['customer'], self.customer.id) 
+        for order in response.data['results']:
+            self.assertEqual(order['customer'], self.customer.id)
+
+    def test_order_list_matches_serializer_output(self):
+        self.api_authentication(self.admin_token)
+
+        other_book = Book.objects.create(title='Other Book', price='12.50', discount='10.00')
+        order = Order.objects.create(customer=self.admin_customer, status='shipped', total_price='35.00')
+        OrderItem.objects.create(order=order, book=other_book, quantity=2, price=other_book.price, discount=other_book.discount)
+        OrderItem.objects.create(order=order, book=None, quantity=1, price='10.00')
+        Order.objects.create(customer=None)
+
+        response = self.client.get(self.order_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        expected = OrderSerializer(Order.objects.order_by('id'), many=True).data
+        self.assertEqual(JSONRenderer().render(response.data['results']), JSONRenderer().render(expected))
+
+    def test_create_order_queries_do_not_grow_with_cart(self):
+        self.api_authentication(self.user_token)
+
+        def checkout(lines):
+            for i in range(lines):
+                book = Book.objects.create(title=f'Book {i}', price=Decimal('12.50'), discount=20, stock=5)
+                Cart.objects.create(customer=self.customer, book=book, quantity=2)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(self.create_url, {})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            return len(context), response
+
+        queries, _ = checkout(0)
+        more_queries, response = checkout(30)
+        self.assertEqual(more_queries, queries)
+
+        order = Order.objects.get(id=response.data['id'])
+        self.assertEqual(order.items.count(), 30)
+        self.assertEqual(order.total_price, Decimal('600.00'))
+        self.assertEqual(order.total_price, order.calculate_total())
+        self.assertFalse(Cart.objects.filter(customer=self.customer).exists())
+
+    def test_create_order_is_atomic(self):
+        self.api_authentication(self.user_token)
+
+        with mock.patch('books_operator.views.OrderItem.objects.bulk_create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post(self.create_url, {})
+
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertTrue(Cart.objects.filter(id=self.cart_item.id).exists())
+
+    def test_create_order_reserves_stock(self):
+        other_book = Book.objects.create(title='Other Book', price=5, stock=1)
+        Cart.objects.create(customer=self.customer, book=other_book, quantity=2)
+        self.api_authentication(self.user_token)
+
+        response = self.client.post(self.create_url, {})
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['books'], [{'book_id': other_book.id, 'title': 'Other Book', 'requested': 2, 'available': 1}])
+        self.assertEqual(Cart.objects.filter(customer=self.customer).count(), 2)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.stock, 10)
+
+        Cart.objects.filter(book=other_book).update(quantity=1)
+        response = self.client.post(self.create_url, {})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(list(Book.objects.filter(id__in=[self.book.id, other_book.id]).order_by('id').values_list('stock', flat=True)), [9, 0])
+
+    def test_create_order_with_idempotency_key(self):
+        self.api_authentication(self.user_token)
+
+        response = self.client.post(self.create_url, {}, HTTP_IDEMPOTENCY_KEY='checkout-1')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # The retry only looks the key up, so it doesn't fail on the now empty cart
+        with self.assertNumQueries(4):
+            retry = self.client.post(self.create_url, {}, HTTP_IDEMPOTENCY_KEY='checkout-1')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data['id'], response.data['id'])
+        self.assertEqual(Order.objects.filter(customer=self.customer).count(), 2)
+        self.assertEqual(OutboxEvent.objects.filter(topic='order_topic').count(), 1)
+
+        # Keys are per user
+        self.api_authentication(self.admin_token)
+        response = self.client.post(self.create_url, {}, HTTP_IDEMPOTENCY_KEY='checkout-1')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_order_events_go_through_outbox(self):
+        self.api_authentication(self.user_token)
+        response = self.client.post(self.create_url, {})
+        order_id = response.data['id']
+
+        self.api_authentication(self.admin_token)
+        self.client.patch(reverse('orders-detail', args=[order_id]), {'status': 'processed'})
+
+        events = list(OutboxEvent.objects.order_by('id'))
+        self.assertEqual([(event.topic, event.key, event.payload['order_action']) for event in events], [
+            ('order_topic', str(order_id), 'create'),
+            ('order_topic', str(order_id), 'update'),
+        ])
+        # The payloads match the order_topic schema
+        for event in events:
+            self.assertEqual(decode_event(event.topic, encode_event(event.topic, event.payload)), event.payload)
+
+        # Nothing is recorded for a checkout that rolls back
+        Cart.objects.create(customer=self.customer, book=self.book, quantity=1)
+        self.api_authentication(self.user_token)
+        with mock.patch('books_operator.views.OrderItem.objects.bulk_create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post(self.create_url, {})
+        self.assertEqual(OutboxEvent.objects.count(), 2)
+
+    def test_delivered_order_items_event(self):
+        single_order = Order.objects.create(customer=self.customer, discount=0)
+        OrderItem.objects.create(order=single_order, book=self.book, quantity=1, price=self.book.price)
+        books = [Book.objects.create(title=f'Book {i}', price=5, stock=10) for i in range(4)]
+        OrderItem.objects.bulk_create(OrderItem(order=self.order, book=book, quantity=2, price=5, discount=10) for book in books)
+        OrderItem.objects.create(order=self.order, book=None, quantity=1, price=3)
+        self.api_authentication(self.admin_token)
+
+        # The items and their books are read in one query, so six items cost as much as one
+        with CaptureQueriesContext(connection) as single:
+            self.client.patch(reverse('orders-detail', args=[single_order.id]), {'status': 'delivered'})
+        with CaptureQueriesContext(connection) as several:
+            response = self.client.patch(self.order_detail_url, {'status': 'delivered'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(several), len(single))
+
+        event = OutboxEvent.objects.get(topic='order_items_topic', key=str(self.order.id))
+        self.assertEqual(event.key, str(self.order.id))
+        self.assertEqual((event.payload['order_id'], event.payload['chunk'], event.payload['chunks']), (self.order.id, 0, 1))
+        self.assertEqual([item['book_title'] for item in event.payload['items']], ['Sample Book', 'Book 0', 'Book 1', 'Book 2', 'Book 3', 'Unknown'])
+        self.assertEqual(event.payload['items'][1]['total_price'], '9.0000')
+        self.assertEqual(decode_event(event.topic, encode_event(event.topic, event.payload)), event.payload)
+
+    @override_settings(ORDER_ITEMS_EVENT_CHUNK_SIZE=2)
+    def test_delivered_order_items_are_chunked(self):
+        books = [Book.objects.create(title=f'Book {i}', price=5, stock=10) for i in range(4)]
+        OrderItem.objects.bulk_create(OrderItem(order=self.order, book=book, quantity=1, price=5) for book in books)
+        self.api_authentication(self.admin_token)
+        self.client.patch(self.order_detail_url, {'status': 'delivered'})
+
+        events = list(OutboxEvent.objects.filter(topic='order_items_topic').order_by('id'))
+        self.assertEqual([(event.key, event.payload['chunk'], event.payload['chunks'], len(event.payload['items'])) for event in events], [
+            (str(self.order.id), 0, 3, 2),
+            (str(self.order.id), 1, 3, 2),
+            (str(self.order.id), 2, 3, 1),
+        ])
+
+    @override_settings(EVENT_TRANSPORT='memory')
+    def test_relay_outbox(self):
+        transport = get_event_transport()
+        transport.clear()
+        events = [enqueue_event('order_topic', {'order_id': i}, key=i) for i in range(5)]
+        OutboxEvent.objects.filter(id=events[0].id).update(sent_at=timezone.now() - timedelta(hours=25))
+
+        # The second message of the batch fails, only the event before it is marked sent
+        with mock.patch.object(transport, 'send_batch', return_value={1}) as send_batch:
+            call_command('relay_outbox', once=True, batch_size=10, stdout=io.StringIO())
+        topic, key, value = send_batch.call_args.args[0][0]
+        self.assertEqual((topic, key, decode_event(topic, value)['order_id']), ('order_topic', '1', 1))
+        self.assertEqual(list(OutboxEvent.objects.filter(sent_at__isnull=True).values_list('id', flat=True)), [event.id for event in events[2:]])
+        # The event sent more than OUTBOX_RETENTION_HOURS ago is pruned
+        self.assertFalse(OutboxEvent.objects.filter(id=events[0].id).exists())
+
+        out = io.StringIO()
+        call_command('relay_outbox', once=True, batch_size=2, stdout=out)
+        self.assertIn('Sent 3 events', out.getvalue())
+        self.assertEqual([message[1] for message in transport.messages], ['2', '3', '4'])
+        self.assertFalse(OutboxEvent.objects.filter(sent_at__isnull=True).exists())
+
+    @override_settings(EVENT_TRANSPORT='memory', EVENT_DEFAULT_ENCODING='msgpack')
+    def test_relay_encodes_with_the_written_schema_version(self):
+        transport = get_event_transport()
+        transport.clear()
+        item = {'book_id': 1, 'book_title': 'Book', 'quantity': 1, 'price': '5.00', 'discount': '0.00', 'total_price': '5.00', 'purchase_date': '2024-05-01T10:00:00+00:00'}
+        old = OutboxEvent.objects.create(topic='order_items_topic', key='1', payload=item, schema_version=1)
+        broken = enqueue_event('order_topic', {'order_id': 1, 'note': 'not in the schema'}, key=1)
+        new = enqueue_event('order_topic', {'order_id': 2}, key=2)
+        self.assertEqual(new.schema_version, 1)
+
+        out = io.StringIO()
+        call_command('relay_outbox', once=True, stdout=out)
+        self.assertIn('Sent 2 events, failed to encode 1', out.getvalue())
+
+        topic, _, value = transport.messages[0]
+        self.assertEqual(HEADER.unpack_from(value), (0, 1))
+        self.assertEqual(decode_event(topic, value), item)
+        self.assertEqual([message[1] for message in transport.messages], ['1', '2'])
+
+        broken.refresh_from_db()
+        self.assertIsNone(broken.sent_at)
+        self.assertIn('note', broken.error)
+        self.assertFalse(OutboxEvent.objects.filter(sent_at__isnull=True, failed_at__isnull=True).exists())
+
+    def test_sweep_idempotency_keys(self):
+        old = IdempotencyKey.objects.create(key='old', scope='/orders/create_order/:1', request_hash='', status_code=201)
+        IdempotencyKey.objects.create(key='new', scope='/orders/create_order/:1', request_hash='', status_code=201)
+        IdempotencyKey.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(hours=25))
+
+        out = io.StringIO()
+        call_command('sweep_idempotency_keys', stdout=out)
+        self.assertIn('Deleted 1 idempotency keys older than 24 hours.', out.getvalue())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['new'])
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    CUSTOMERS = 12
+    STOCK = 5
+
+    def setUp(self):
+        self.hot_book = Book.objects.create(title='Hot Book', price=10, stock=self.STOCK)
+        self.other_book = Book.objects.create(title='Other Book', price=10, stock=100)
+        self.tokens = []
+        for i in range(self.CUSTOMERS):
+            user = User.objects.create_user(username=f'buyer{i}', password='password')
+            customer = Customer.objects.create(user=user, phone_number=f'555000{i:04d}')
+            # Half of the carts list the books the other way round, locking stays in id order
+            books = [self.hot_book, self.other_book] if i % 2 else [self.other_book, self.hot_book]
+            for book in books:
+                Cart.objects.create(customer=customer, book=book, quantity=1)
+            self.tokens.append(str(AccessToken.for_user(user)))
+
+    def test_concurrent_checkouts_never_oversell(self):
+        barrier = threading.Barrier(self.CUSTOMERS)
+        statuses, errors = [], []
+
+        def checkout(token):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+            try:
+                barrier.wait()
+                statuses.append(client.post(reverse('orders-create-order'), {}).status_code)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(token,)) for token in self.tokens]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(statuses.count(status.HTTP_201_CREATED), self.STOCK)
+        self.assertEqual(statuses.count(status.HTTP_409_CONFLICT), self.CUSTOMERS - self.STOCK)
+        self.hot_book.refresh_from_db()
+        self.other_book.refresh_from_db()
+        self.assertEqual(self.hot_book.stock, 0)
+        self.assertEqual(self.other_book.stock, 100 - self.STOCK)
+        self.assertEqual(OrderItem.objects.filter(book=self.hot_book).count(), self.STOCK)
+
+    def test_concurrent_checkouts_of_one_cart_order_it_once(self):
+        barrier = threading.Barrier(8)
+        statuses, errors = [], []
+
+        def checkout():
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.tokens[0]}')
+            try:
+                barrier.wait()
+                statuses.append(client.post(reverse('orders-create-order'), {}).status_code)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(statuses), [status.HTTP_201_CREATED] + [status.HTTP_400_BAD_REQUEST] * 7)
+        self.assertEqual(Order.objects.count(), 1)
+        self.hot_book.refresh_from_db()
+        self.assertEqual(self.hot_book.stock, self.STOCK - 1)
+
+    def test_concurrent_retries_with_one_idempotency_key_run_once(self):
+        barrier = threading.Barrier(8)
+        responses, errors = [], []
+
+        def checkout():
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.tokens[0]}')
+            try:
+                barrier.wait()
+                responses.append(client.post(reverse('orders-create-order'), {}, HTTP_IDEMPOTENCY_KEY='retry-storm'))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual({response.status_code for response in responses}, {status.HTTP_201_CREATED})
+        self.assertEqual(len({response.data['id'] for response in responses}), 1)
+        self.assertEqual(Order.objects.count(), 1)
+        self.hot_book.refresh_from_db()
+        self.assertEqual(self.hot_book.stock, self.STOCK - 1)
+
+
+@override_settings(EVENT_TRANSPORT='memory')
+class ConcurrentRelayTests(TransactionTestCase):
+
+    def test_concurrent_relays_send_in_id_order(self):
+        transport = get_event_transport()
+        transport.clear()
+        ids = [enqueue_event('order_topic', {'order_id': i}, key=i).id for i in range(40)]
+        send_batch = transport.send_batch
+        barrier = threading.Barrier(4)
+        errors = []
+
+        # Every other batch is slow to deliver, a relay without the lock would send the next batch meanwhile
+        def slow_send_batch(messages):
+            if int(messages[0][1]) % 10 == 0:
+                time.sleep(0.1)
+            return send_batch(messages)
+
+        def relay():
+            try:
+                barrier.wait()
+                while sum(relay_batch(5)):
+                    pass
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        with mock.patch.object(transport, 'send_batch', side_effect=slow_send_batch):
+            threads = [threading.Thread(target=relay) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual([int(message[1]) for message in transport.messages], list(range(40)))
+        self.assertFalse(OutboxEvent.objects.filter(id__in=ids, sent_at__isnull=True).exists())
@@ -1,8 +1,18 @@
+import io
+import json
+import tempfile
+from decimal import Decimal
+from unittest import mock
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
-from books_operator.models import User, Customer
+from books_operator.models import User, Customer, Book, Review
+from books_operator.review_import import import_reviews
 
 
 class CustomerViewSetTest(APITestCase):
@@ -70,15 +80,15 @@ class CustomerViewSetTest(APITestCase):
 
         response = self.client.get(self.profile_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data[0]['username'], self.regular_user.username)
-        self.assertEqual(response.data[0]['phone_number'], self.regular_customer.phone_number)
+        self.assertEqual(response.data['results'][0]['username'], self.regular_user.username)
+        self.assertEqual(response.data['results'][0]['phone_number'], self.regular_customer.phone_number)
 
     def test_get_profile_as_admin(self):
         self.api_authentication(self.admin_token)
 
         response = self.client.get(self.profile_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), Customer.objects.count())
+        self.assertEqual(len(response.data['results']), Customer.objects.count())
 
     def test_update_profile_as_regular_user(self):
         self.api_authentication(self.regular_token)
@@ -126,5 +136,296 @@ class CustomerViewSetTest(APITestCase):
         response = self.client.delete(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertFalse(Customer.objects.filter(id=self.regular_customer.id).exists())
-        self.assertFalse(User.objects.filter(id=self.regular_user.id).exists()) 
+        self.assertFalse(User.objects.filter(id=self.regular_user.id).exists())
 
+
+class ReviewTests(APITestCase):
+
+    def setUp(self):
+        caches['catalog'].clear()
+
+        self.user = User.objects.create_user(username='reader', password='password')
+        self.other_user = User.objects.create_user(username='other_reader', password='password')
+
+        self.book = Book.objects.create(title='Rated Book', price=10)
+        self.other_book = Book.objects.create(title='Other Book', price=20)
+
+        self.user_token = str(AccessToken.for_user(self.user))
+        self.other_token = str(AccessToken.for_user(self.other_user))
+
+    def api_authentication(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+
+    def assertRating(self, book, count, total, average):
+        book.refresh_from_db()
+        self.assertEqual((book.rating_count, book.rating_sum, book.rating_avg), (count, total, Decimal(average)))
+
+    def test_rating_counters_follow_review_changes(self):
+        self.api_authentication(self.user_token)
+        response = self.client.post(reverse('reviews-list'), {'book': self.book.id, 'rating': 5})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        review_id = response.data['id']
+
+        self.api_authentication(self.other_token)
+        self.client.post(reverse('reviews-list'), {'book': self.book.id, 'rating': 2})
+        self.assertRating(self.book, 2, 7, '3.50')
+
+        # Second review of the same book is rejected and not counted
+        response = self.client.post(reverse('reviews-list'), {'book': self.book.id, 'rating': 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertRating(self.book, 2, 7, '3.50')
+
+        self.api_authentication(self.user_token)
+        url = reverse('reviews-detail', args=[review_id])
+        self.client.patch(url, {'rating': 3})
+        self.assertRating(self.book, 2, 5, '2.50')
+
+        self.client.patch(url, {'book': self.other_book.id})
+        self.assertRating(self.book, 1, 2, '2.00')
+        self.assertRating(self.other_book, 1, 3, '3.00')
+
+        self.client.delete(url)
+        self.assertRating(self.other_book, 0, 0, '0.00')
+
+        response = self.client.get(reverse('books-detail', args=[self.book.id]))
+        self.assertEqual(response.data['rating_avg'], '2.00')
+        self.assertEqual(response.data['rating_count'], 1)
+
+    def test_books_sorted_by_rating(self):
+        Review.objects.create(book=self.other_book, user=self.user, rating=4)
+        Book.objects.filter(id=self.other_book.id).update(rating_count=1, rating_sum=4)
+
+        response = self.client.get(reverse('books-list'), {'ordering': '-rating_avg'})
+        self.assertEqual([book['title'] for book in response.data['results']], ['Other Book', 'Rated Book'])
+
+    def test_rebuild_book_ratings_command(self):
+        Review.objects.create(book=self.book, user=self.user, rating=4)
+        Review.objects.create(book=self.book, user=self.other_user, rating=1)
+        Book.objects.filter(id=self.other_book.id).update(rating_count=3, rating_sum=9)
+
+        call_command('rebuild_book_ratings', chunk_size=1, stdout=open('/dev/null', 'w'))
+
+        self.assertRating(self.book, 2, 5, '2.50')
+        self.assertRating(self.other_book, 0, 0, '0.00')
+
+    def test_book_reviews_conditional_get(self):
+        review = Review.objects.create(book=self.book, user=self.user, rating=4)
+        url = reverse('reviews-book-reviews', args=[self.book.id])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+        # A deleted review changes the validator even though no row got newer
+        Review.objects.create(book=self.book, user=self.other_user, rating=2)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        review.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        # The payload shows the book title and the user name, renaming them changes the validator
+        self.book.title = 'Renamed Book'
+        self.book.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        self.other_user.username = 'renamed'
+        self.other_user.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['user_name'], 'renamed')
+
+    def test_malformed_ids_are_not_found(self):
+        self.assertEqual(self.client.get(reverse('reviews-book-reviews', args=['abc'])).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(reverse('books-detail', args=['abc'])).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_review_sparse_fieldsets(self):
+        Review.objects.create(book=self.book, user=self.user, rating=4, comment='Nice')
+        self.api_authentication(self.user_token)
+
+        response = self.client.get(reverse('reviews-list'), {'fields': 'rating,book_title'})
+        self.assertEqual(response.data['results'], [{'rating': 4, 'book_title': 'Rated Book'}])
+
+        response = self.client.get(reverse('reviews-my-reviews'), {'exclude': 'comment'})
+        self.assertNotIn('comment', response.data['results'][0])
+        self.assertEqual(response.data['results'][0]['user_name'], 'reader')
+
+    def add_reviews(self, count, **kwargs):
+        for i in range(count):
+            book = Book.objects.create(title=f'Extra {i}', price=5)
+            user = User.objects.create_user(username=f'extra_{User.objects.count()}', password='password')
+            Review.objects.create(book=kwargs.get('book', book), user=kwargs.get('user', user), rating=3)
+
+    def count_queries(self, url, params=None):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context), response
+
+    # The number of queries of a review read must not depend on how many reviews it returns
+    def assertConstantQueries(self, url, add_reviews, params=None):
+        add_reviews(1)
+        queries, _ = self.count_queries(url, params)
+        add_reviews(10)
+        more_queries, response = self.count_queries(url, params)
+        self.assertGreater(len(response.data['results']), 10)
+        self.assertEqual(more_queries, queries)
+
+    def test_review_list_queries_are_constant(self):
+        admin = User.objects.create_superuser(username='admin', password='password')
+        self.api_authentication(str(AccessToken.for_user(admin)))
+        self.assertConstantQueries(reverse('reviews-list'), self.add_reviews)
+
+        # Pages rendered from model instances by the serializer itself
+        with mock.patch('books_operator.views.ValuesSerializer.build', return_value=None):
+            self.assertConstantQueries(reverse('reviews-list'), self.add_reviews)
+            self.assertConstantQueries(reverse('reviews-list'), self.add_reviews, {'fields': 'rating,book_title'})
+
+    def test_my_reviews_queries_are_constant(self):
+        self.api_authentication(self.user_token)
+        self.assertConstantQueries(reverse('reviews-my-reviews'), lambda count: self.add_reviews(count, user=self.user))
+
+    def test_user_reviews_queries_are_constant(self):
+        admin = User.objects.create_superuser(username='admin', password='password')
+        customer = Customer.objects.create(user=self.user, phone_number='1234567890')
+        self.api_authentication(str(AccessToken.for_user(admin)))
+        url = reverse('reviews-user-reviews', args=[customer.id])
+        self.assertConstantQueries(url, lambda count: self.add_reviews(count, user=self.user))
+
+    def test_book_reviews_queries_are_constant(self):
+        url = reverse('reviews-book-reviews', args=[self.book.id])
+        self.assertConstantQueries(url, lambda count: self.add_reviews(count, book=self.book))
+
+    def test_review_retrieve_loads_relations_in_one_query(self):
+        review = Review.objects.create(book=self.book, user=self.user, rating=4)
+        self.api_authentication(self.user_token)
+
+        # User lookup, conditional aggregate and the review with its book and user
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('reviews-detail', args=[review.id]))
+        self.assertEqual((response.data['book_title'], response.data['user_name']), ('Rated Book', 'reader'))
+
+    def test_rating_histogram(self):
+        Review.objects.create(book=self.book, user=self.user, rating=5)
+        Review.objects.create(book=self.book, user=self.other_user, rating=2)
+        Review.objects.create(book=self.other_book, user=self.user, rating=2)
+        url = reverse('reviews-rating-histogram', args=[self.book.id])
+
+        # Book lookup and the conditional aggregate
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(response.data['histogram'], {'1': 0, '2': 1, '3': 0, '4': 0, '5': 1})
+
+        # A new review bumps the catalog version, so the cached histogram is not served
+        self.api_authentication(str(AccessToken.for_user(User.objects.create_user(username='third', password='password'))))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('reviews-list'), {'book': self.book.id, 'rating': 2})
+        response = self.client.get(url)
+        self.assertEqual(response.data['histogram']['2'], 2)
+
+        self.assertEqual(self.client.get(reverse('reviews-rating-histogram', args=[999999])).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(reverse('reviews-rating-histogram', args=['abc'])).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_book_reviews_sorted_feed(self):
+        ratings = [3, 5, 1, 5, 3, 5, 2]
+        for rating in ratings:
+            self.add_reviews(1, book=self.book)
+            Review.objects.filter(pk=Review.objects.latest('id').pk).update(rating=rating)
+        url = reverse('reviews-book-reviews', args=[self.book.id])
+
+        def walk(sort):
+            rows, response = [], self.client.get(url, {'sort': sort, 'page_size': 2})
+            while True:
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                rows += response.data['results']
+                if response.data['next'] is None:
+                    return rows
+                response = self.client.get(response.data['next'])
+
+        reviews = Review.objects.filter(book=self.book)
+        self.assertEqual([row['id'] for row in walk('newest')], list(reviews.order_by('-created_at', '-id').values_list('id', flat=True)))
+        self.assertEqual([row['id'] for row in walk('highest')], list(reviews.order_by('-rating', '-id').values_list('id', flat=True)))
+        self.assertEqual([row['rating'] for row in walk('lowest')], sorted(ratings))
+
+        response = self.client.get(url, {'sort': 'oldest'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'cursor': 'broken'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_bulk_import_reviews(self):
+        Review.objects.create(book=self.book, user=self.user, rating=4)
+        Book.objects.filter(id=self.book.id).update(rating_count=1, rating_sum=4)
+        url = reverse('reviews-bulk-import')
+        body = '\n'.join(json.dumps(row) for row in [
+            {'user': self.user.id, 'book': self.book.id, 'rating': 1},
+            {'user': self.other_user.id, 'book': self.book.id, 'rating': 2, 'comment': 'Meh'},
+            {'user': self.other_user.id, 'book': self.book.id, 'rating': 5},
+            {'user': self.user.id, 'book': self.other_book.id, 'rating': 9},
+            {'user': self.user.id, 'book': 0, 'rating': 3},
+            {'user': self.user.id, 'book': self.other_book.id, 'rating': 3},
+        ])
+
+        self.api_authentication(self.user_token)
+        response = self.client.post(url, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        admin = User.objects.create_superuser(username='admin', password='password')
+        self.api_authentication(str(AccessToken.for_user(admin)))
+        # Admin lookup, users, books, existing pairs, and the insert in its own savepoint with the recount
+        with self.assertNumQueries(10):
+            response = self.client.post(url, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['skipped']), (2, 2))
+        self.assertEqual([error['row'] for error in response.data['errors']], [4, 5])
+        self.assertIn('rating', response.data['errors'][0]['errors'])
+        self.assertRating(self.book, 2, 6, '3.00')
+        self.assertRating(self.other_book, 1, 3, '3.00')
+
+        third = User.objects.create_user(username='third', password='password')
+        csv_body = f'user,book,rating,comment\n{third.id},{self.other_book.id},5,"Great, really"\n'
+        response = self.client.post(url, csv_body, content_type='text/csv')
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(Review.objects.get(user=third).comment, 'Great, really')
+
+        # A review written concurrently after the pair lookup is reported as skipped, not created
+        fourth = User.objects.create_user(username='fourth', password='password')
+        Review.objects.create(user=fourth, book=self.book, rating=1)
+        lookups = []
+        review_filter = Review.objects.filter
+
+        # The first lookup of existing pairs doesn't see the review yet
+        def stale_filter(*args, **kwargs):
+            lookups.append(kwargs)
+            return Review.objects.none() if len(lookups) == 1 else review_filter(*args, **kwargs)
+
+        rows = [{'user': fourth.id, 'book': self.book.id, 'rating': 4}, {'user': fourth.id, 'book': self.other_book.id, 'rating': 4}]
+        with mock.patch.object(Review.objects, 'filter', side_effect=stale_filter):
+            report = import_reviews(rows)
+        self.assertEqual((report['created'], report['skipped']), (1, 1))
+        self.assertEqual(Review.objects.get(user=fourth, book=self.book).rating, 1)
+
+        response = self.client.post(url, '{"user": 1,\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_reviews_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as file:
+            file.write('user,book,rating\n')
+            file.write(f'{self.user.id},{self.book.id},4\n{self.other_user.id},{self.book.id},2\n{self.user.id},{self.other_book.id},0\n')
+            file.flush()
+            output, errors = io.StringIO(), io.StringIO()
+            call_command('import_reviews', file.name, batch_size=1, stdout=output, stderr=errors)
+
+        self.assertIn('Created 2 reviews, skipped 0 duplicates, rejected 1 rows.', output.getvalue())
+        self.assertIn('Row 3:', errors.getvalue())
+        self.assertRating(self.book, 2, 6, '3.00')
@@ -3,29 +3,96 @@ from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAdminUser, I
 from rest_framework.exceptions import ValidationError
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.decorators import action  
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.shortcuts import get_object_or_404
+# Unlike the django.shortcuts one, answers 404 for malformed ids too
+from rest_framework.generics import get_object_or_404
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import F, Q, Count, DecimalField
+from django.db.models.functions import Cast, Greatest
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
 from .models import *
 from .serializers import *
-from .kafka_producer import *
-import json
-
-
-class AddBookToStore(viewsets.ModelViewSet):
+from .pagination import BookCursorPagination, RankCursorPagination, ReviewFeedPagination
+from .fast_serializers import ValuesSerializer
+from .ratings import apply_rating_change
+from .catalog_cache import cached_catalog_response, catalog_cache_stats
+from .conditional import conditional_get
+from .parsers import CSVParser, NDJSONParser
+from .review_import import import_reviews
+from .cart_totals import cart_summary, line_totals, with_line_totals
+from .cart_batch import apply_cart_batch
+from .cart_store import get_cart_store
+from .stock import OutOfStock, reserve_stock
+from .idempotency import idempotent
+from .outbox import enqueue_event
+from decimal import Decimal, InvalidOperation
+from contextlib import ExitStack
+
+
+AUTOCOMPLETE_DEFAULT_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+
+class PaginatedActionMixin:
+    def list(self, request, *args, **kwargs):
+        return self.paginated_response(self.get_queryset())
+
+    # Filter and paginate list actions. Pages are rendered from .values() rows when the
+    # serializer allows it, with the same output as the serializer itself
+    def paginated_response(self, queryset, paginator=None):
+        paginator = paginator or self.paginator
+        queryset = self.filter_queryset(queryset)
+
+        fast_serializer = ValuesSerializer.build(self.get_serializer(), queryset)
+        if fast_serializer is None:
+            page = paginator.paginate_queryset(queryset, self.request, view=self)
+            serializer = self.get_serializer(page, many=True)
+            return paginator.get_paginated_response(serializer.data)
+
+        # The cursor is read from the ordering fields of the page rows
+        ordering = [field.lstrip('-') for field in paginator.get_ordering(self.request, queryset, self)]
+        page = paginator.paginate_queryset(fast_serializer.values(queryset, *ordering), self.request, view=self)
+        return paginator.get_paginated_response(fast_serializer.render(page))
+
+
+class SparseFieldsetViewMixin:
+    # Read from the database only the columns the serializer is going to render
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return self.get_serializer_class().project_queryset(queryset, self.request)
+
+
+class AddBookToStore(SparseFieldsetViewMixin, PaginatedActionMixin, viewsets.ModelViewSet):
     queryset = Book.objects.all()
     serializer_class = BookSerializer
     permission_classes = [IsAdminUser]  
+    # ?ordering= is honoured by every list action
+    pagination_class = BookCursorPagination
 
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update', 'destroy']:  
+        if self.action in ['create', 'update', 'partial_update', 'destroy', 'cache_stats']:  
             self.permission_classes = [IsAdminUser]
         else:
             self.permission_classes = [IsAuthenticatedOrReadOnly]
         return super().get_permissions()
 
+    @cached_catalog_response
+    @conditional_get(lambda view: view.get_queryset())
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cached_catalog_response
+    @conditional_get(lambda view: view.get_queryset().filter(pk=view.kwargs['pk']))
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
     # Filter book list by author    
     @action(detail=False, methods=['get'])
+    @cached_catalog_response
     def by_author(self, request):
         author = request.query_params.get('author')
     
@@ -34,11 +101,11 @@ class AddBookToStore(viewsets.ModelViewSet):
         else:
            books = Book.objects.all()
     
-        serializer = self.get_serializer(books, many=True)
-        return Response(serializer.data)
+        return self.paginated_response(books)
 
     # Filter book list by genre    
     @action(detail=False, methods=['get'])
+    @cached_catalog_response
     def by_genre(self, request):
         genre = request.query_params.get('genre')
 
@@ -47,19 +114,123 @@ class AddBookToStore(viewsets.ModelViewSet):
         else:
            books = Book.objects.all()
 
-        serializer = self.get_serializer(books, many=True)
-        return Response(serializer.data)
-        return Response({"detail": "Genre not provided"}, status=400)
+        return self.paginated_response(books)
 
-    # Search book by title
+    # Search books. ?q= runs ranked full-text search over title, author, synopsis and description,
+    # ?title= keeps the plain substring search by title
     @action(detail=False, methods=['get'])
+    @cached_catalog_response
     def search(self, request):
+        query = request.query_params.get('q')
         title = request.query_params.get('title')
+
+        if query:
+            search_query = SearchQuery(query, search_type='websearch', config=BOOK_SEARCH_CONFIG)
+            books = Book.objects.filter(search_vector=search_query).annotate(
+                rank=Cast(SearchRank(F('search_vector'), search_query), DecimalField(max_digits=12, decimal_places=9))
+            )
+            return self.paginated_response(books, RankCursorPagination())
+
         if title:
             books = Book.objects.filter(title__icontains=title)
-            serializer = self.get_serializer(books, many=True)
-            return Response(serializer.data)
-        return Response({"detail": "Title not provided"}, status=400)
+            return self.paginated_response(books)
+        return Response({"detail": "Search query or title not provided"}, status=400)
+
+    # Search-as-you-type suggestions by title or author, tolerant to typos.
+    # Served by the trigram GIN indexes and returns only id, title and author
+    @action(detail=False, methods=['get'])
+    @cached_catalog_response
+    def autocomplete(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"detail": "Search query not provided"}, status=400)
+
+        try:
+            limit = int(request.query_params.get('limit', AUTOCOMPLETE_DEFAULT_LIMIT))
+        except ValueError:
+            return Response({"detail": "Limit must be an integer"}, status=400)
+        limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+
+        books = Book.objects.filter(
+            Q(title__trigram_word_similar=query) | Q(author__trigram_word_similar=query)
+        ).annotate(
+            similarity=Greatest(TrigramWordSimilarity(query, 'title'), TrigramWordSimilarity(query, 'author'))
+        ).order_by('-similarity', 'id').values('id', 'title', 'author')[:limit]
+
+        return Response(list(books))
+
+    # One catalog filter for genre, author, price range, in stock and discounted books.
+    # Returns a page of books plus facet counts for the whole filtered set
+    @action(detail=False, methods=['get'])
+    @cached_catalog_response
+    def filter(self, request):
+        params = request.query_params
+        books = Book.objects.all()
+
+        if params.get('genre'):
+            books = books.filter(genre=params['genre'])
+        if params.get('author'):
+            books = books.filter(author=params['author'])
+
+        try:
+            min_price = Decimal(params['min_price']) if params.get('min_price') else None
+            max_price = Decimal(params['max_price']) if params.get('max_price') else None
+        except InvalidOperation:
+            return Response({"detail": "Price must be a number"}, status=400)
+        # Decimal() also accepts NaN and Infinity, the database does not
+        if any(price is not None and not price.is_finite() for price in (min_price, max_price)):
+            return Response({"detail": "Price must be a number"}, status=400)
+        if min_price is not None:
+            books = books.filter(price__gte=min_price)
+        if max_price is not None:
+            books = books.filter(price__lte=max_price)
+
+        if params.get('in_stock') in ('1', 'true'):
+            books = books.filter(stock__gt=0)
+        if params.get('discounted') in ('1', 'true'):
+            books = books.filter(discount__gt=0)
+
+        response = self.paginated_response(books)
+        response.data['facets'] = self.facet_counts(books)
+        return response
+
+    # All facets come from a single GROUP BY genre query with conditional counts,
+    # price buckets and stock counts are summed up across the genre rows
+    def facet_counts(self, books):
+        bounds = [None, *settings.BOOK_PRICE_FACET_BUCKETS, None]
+        buckets = list(zip(bounds, bounds[1:]))
+
+        price_counts = {}
+        for index, (low, high) in enumerate(buckets):
+            condition = Q()
+            if low is not None:
+                condition &= Q(price__gte=low)
+            if high is not None:
+                condition &= Q(price__lt=high)
+            price_counts[f'price_{index}'] = Count('id', filter=condition)
+
+        rows = books.order_by().values('genre').annotate(
+            total=Count('id'),
+            in_stock=Count('id', filter=Q(stock__gt=0)),
+            **price_counts,
+        )
+
+        facets = {
+            'genre': {},
+            'price': [{'min': low, 'max': high, 'count': 0} for low, high in buckets],
+            'in_stock': 0,
+        }
+        for row in rows:
+            facets['genre'][row['genre']] = row['total']
+            facets['in_stock'] += row['in_stock']
+            for index, bucket in enumerate(facets['price']):
+                bucket['count'] += row[f'price_{index}']
+        return facets
+
+    # Hit/miss counters of the catalog response cache for admins
+    @action(detail=False, methods=['get'])
+    def cache_stats(self, request):
+        return Response(catalog_cache_stats())
 
 
 class CustomerViewSet(viewsets.ModelViewSet):
@@ -77,6 +248,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
             return [AllowAny()]
         return super().get_permissions()
 
+    @idempotent
     def create(self, request, *args, **kwargs):
         if request.user.is_authenticated:
             raise PermissionDenied("You are already authenticated, you cannot create an account.")
@@ -122,21 +294,19 @@ class CustomerViewSet(viewsets.ModelViewSet):
 
         serializer = self.get_serializer(customer, data=request.data, partial=False)
         serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
 
-        if serializer.instance:
+        with transaction.atomic():
+            self.perform_update(serializer)
 
             customer_data = {
                 'user_action': 'update',     
                 'customer_id': customer.id,
-                'username': user.username,
+                'username': customer.user.username,
                 'phone_number': customer.phone_number,  
                 'spent_money': str(customer.total_spent),  
                 'date_joined': customer.user.date_joined.isoformat() 
             }
-
-            customer_json = json.dumps(customer_data)
-            send_message('customer_topic', customer_json)
+            enqueue_event('customer_topic', customer_data, key=customer.id)
 
         return Response(serializer.data)
 
@@ -161,15 +331,25 @@ class CustomerViewSet(viewsets.ModelViewSet):
         return Response({"detail": "Client successfully deleted."}, status=status.HTTP_200_OK)
 
 
-class ReviewViewSet(viewsets.ModelViewSet):
+class ReviewViewSet(SparseFieldsetViewMixin, PaginatedActionMixin, viewsets.ModelViewSet):
     queryset = Review.objects.all()
     serializer_class = ReviewSerializer
     permission_classes = [IsAuthenticated]
 
+    # Serializers render book.title and user.username, join them instead of a query per review
     def get_queryset(self):
+        reviews = Review.objects.select_related('book', 'user')
         if self.request.user.is_staff:
-            return Review.objects.all()
-        return Review.objects.filter(user=self.request.user)
+            return reviews
+        return reviews.filter(user=self.request.user)
+
+    @conditional_get(lambda view: view.get_queryset())
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional_get(lambda view: view.get_queryset().filter(pk=view.kwargs['pk']))
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         book_id = self.request.data.get('book')
@@ -177,9 +357,27 @@ class ReviewViewSet(viewsets.ModelViewSet):
         existing_review = Review.objects.filter(book=book, user=self.request.user).first()
         
         if existing_review:
-            return Response({"error": "You have already reviewed this book."}, status=status.HTTP_400_BAD_REQUEST)
-        
-        serializer.save(user=self.request.user, book=book)
+            raise ValidationError({"error": "You have already reviewed this book."})
+
+        with transaction.atomic():
+            review = serializer.save(user=self.request.user, book=book)
+            apply_rating_change(book.id, 1, review.rating)
+
+    def perform_update(self, serializer):
+        old_book_id, old_rating = serializer.instance.book_id, serializer.instance.rating
+
+        with transaction.atomic():
+            review = serializer.save()
+            if review.book_id == old_book_id:
+                apply_rating_change(review.book_id, 0, review.rating - old_rating)
+            else:
+                apply_rating_change(old_book_id, -1, -old_rating)
+                apply_rating_change(review.book_id, 1, review.rating)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            apply_rating_change(instance.book_id, -1, -instance.rating)
+            instance.delete()
 
     def update(self, request, *args, **kwargs):
         review = self.get_object()
@@ -195,37 +393,84 @@ class ReviewViewSet(viewsets.ModelViewSet):
 
     # Current user reviews list
     @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    @conditional_get(lambda view: Review.objects.filter(user=view.request.user))
     def my_reviews(self, request):
-        reviews = Review.objects.filter(user=request.user)
-        serializer = self.get_serializer(reviews, many=True)
-        return Response(serializer.data)
+        reviews = Review.objects.select_related('book', 'user').filter(user=request.user)
+        return self.paginated_response(reviews)
 
     # Get user reviews for admin
     @action(detail=True, methods=['get'], permission_classes=[IsAdminUser])
+    @conditional_get(lambda view: Review.objects.filter(user__customer=view.kwargs['pk']))
     def user_reviews(self, request, pk=None):
         customer = get_object_or_404(Customer, pk=pk)
-        reviews = Review.objects.filter(user=customer.user)
-        serializer = self.get_serializer(reviews, many=True)
-        return Response(serializer.data)
+        reviews = Review.objects.select_related('book', 'user').filter(user=customer.user)
+        return self.paginated_response(reviews)
 
-    # Get book reviews for everyone 
+    # Get book reviews for everyone, ?sort=newest|highest|lowest
     @action(detail=True, methods=['get'], permission_classes=[])
+    @conditional_get(lambda view: Review.objects.filter(book=view.kwargs['pk']))
     def book_reviews(self, request, pk=None):
         book = get_object_or_404(Book, pk=pk)
-        reviews = Review.objects.filter(book=book)
-        serializer = self.get_serializer(reviews, many=True)
-        return Response(serializer.data)
+        reviews = Review.objects.select_related('book', 'user').filter(book=book)
+        return self.paginated_response(reviews, ReviewFeedPagination())
+
+    # Bulk review import for admin: JSON list, NDJSON or CSV body (user,book,rating,comment)
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser], parser_classes=[JSONParser, NDJSONParser, CSVParser])
+    def bulk_import(self, request):
+        if not isinstance(request.data, list):
+            return Response({"error": "Expected a list of reviews."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(import_reviews(request.data))
+
+    # Number of reviews per star of a book, one query on the (book, rating) index after the book lookup
+    @action(detail=True, methods=['get'], permission_classes=[])
+    @cached_catalog_response
+    def rating_histogram(self, request, pk=None):
+        book = get_object_or_404(Book.objects.only('id'), pk=pk)
+        counts = Review.objects.filter(book=book).aggregate(
+            **{str(rating): Count('id', filter=Q(rating=rating)) for rating in range(1, 6)}
+        )
+        return Response({'book': book.id, 'count': sum(counts.values()), 'histogram': counts})
     
 
-class CartViewSet(viewsets.ModelViewSet):
+class CartViewSet(PaginatedActionMixin, viewsets.ModelViewSet):
     serializer_class = CartSerializer
     queryset = Cart.objects.all()
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
+        carts = with_line_totals(Cart.objects.select_related('book', 'customer__user'))
         if self.request.user.is_staff:
-            return Cart.objects.all()   
-        return Cart.objects.filter(customer=self.request.user.customer) 
+            return carts
+        return carts.filter(customer=self.request.user.customer) 
+
+    # Actions served by the cart store, every other action reads the Cart table, so changes
+    # still held by the store are written there first. Reads are not served from the store:
+    # they flush the cart and read the table without holding the lock, writes keep the cart
+    # locked until the response is ready. The admin list of all carts shows the table as of the last flush_cart_store
+    store_actions = ['create', 'clear_cart']
+    read_actions = ['list', 'retrieve', 'summary', 'user_cart']
+
+    def dispatch(self, request, *args, **kwargs):
+        with ExitStack() as self.cart_sync:
+            return super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        cart_store = get_cart_store()
+        if self.action in self.store_actions or not cart_store.holds_changes:
+            return
+
+        if request.user.is_staff:
+            user_id = self.kwargs.get('user_id', '')
+            customer_id = int(user_id) if self.action == 'user_cart' and user_id.isdigit() else None
+        else:
+            customer_id = request.user.customer.id if hasattr(request.user, 'customer') else None
+        if customer_id is None:
+            return
+        if self.action in self.read_actions:
+            cart_store.flush(customer_id)
+        else:
+            self.cart_sync.enter_context(cart_store.synced(customer_id))
 
     def check_object_permissions(self, request, cart_item):
         if cart_item.customer != request.user.customer or request.user.is_staff:
@@ -237,15 +482,15 @@ class CartViewSet(viewsets.ModelViewSet):
         customer = request.user.customer
         book_id = request.data.get('book_id')
 
-        try:
-            cart_item = Cart.objects.get(customer=customer, book_id=book_id)
+        book = Book.objects.filter(id=book_id).first() if str(book_id).isdigit() else None
+        if book is None:
+            return Response({"error": "The book with the specified ID does not exist."}, status=status.HTTP_400_BAD_REQUEST)
 
-            updated_quantity = cart_item.quantity + 1
-            return self.update_quantity(cart_item, updated_quantity) 
-        except Cart.DoesNotExist:
-            cart_item = Cart.objects.create(customer=customer,book_id=book_id,quantity=1)
-            serializer = self.get_serializer(cart_item)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        cart_store = get_cart_store()
+        created = cart_store.increment(customer.id, book.id)
+        cart_item = cart_store.get_line(customer, book)
+        serializer = self.get_serializer(cart_item)
+        return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
     # You can only update quantity by Patch/Put for this API Enpoint        
     def update(self, request, *args, **kwargs):
@@ -263,6 +508,9 @@ class CartViewSet(viewsets.ModelViewSet):
         
         cart_item.quantity = quantity
         cart_item.save()
+        # The line totals were annotated for the old quantity
+        for name, value in line_totals(cart_item.book.price, cart_item.book.discount, quantity).items():
+            setattr(cart_item, name, value)
         serializer = self.get_serializer(cart_item)
         return Response(serializer.data)
 
@@ -279,7 +527,7 @@ class CartViewSet(viewsets.ModelViewSet):
         if request.user.is_staff:
             return Response({"error": "Admins cannot modify carts."}, status=status.HTTP_403_FORBIDDEN)
 
-        Cart.objects.filter(customer=request.user.customer).delete() 
+        get_cart_store().clear(request.user.customer.id)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     # Get user cart for Admin    
@@ -293,12 +541,43 @@ class CartViewSet(viewsets.ModelViewSet):
         except Customer.DoesNotExist:
             return Response({"error": "Customer not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        cart_items = Cart.objects.filter(customer=customer)
-        serializer = CartSerializer(cart_items, many=True)
-        return Response(serializer.data)
+        cart_items = with_line_totals(Cart.objects.filter(customer=customer))
+        return self.paginated_response(cart_items)
+
+    # Change many cart lines at once: [{"book_id": 1, "quantity": 3}, {"book_id": 2, "increment": 1}, ...]
+    # All changes are applied in one transaction, the response is the resulting cart summary
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        if request.user.is_staff:
+            return Response({"error": "Admins cannot modify carts."}, status=status.HTTP_403_FORBIDDEN)
 
+        serializer = CartBatchItemSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data
+
+        book_ids = [item['book_id'] for item in items]
+        if len(set(book_ids)) != len(book_ids):
+            return Response({"error": "Each book can appear only once in a batch."}, status=status.HTTP_400_BAD_REQUEST)
+        missing = set(book_ids) - set(Book.objects.filter(id__in=book_ids).values_list('id', flat=True))
+        if missing:
+            return Response({"error": f"Books not found: {sorted(missing)}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        customer = request.user.customer
+        apply_cart_batch(
+            customer.id,
+            sets={item['book_id']: item['quantity'] for item in items if item.get('quantity')},
+            increments={item['book_id']: item['increment'] for item in items if 'increment' in item},
+            removals=[item['book_id'] for item in items if item.get('quantity') == 0],
+        )
+        return Response(cart_summary(Cart.objects.filter(customer=customer)))
+
+    # Cart lines with line totals, subtotal, discount and total of the current user in one query
+    @action(detail=False, methods=['get'])
+    def summary(self, request):
+        return Response(cart_summary(Cart.objects.filter(customer__user=request.user)))
 
-class OrderViewSet(viewsets.ModelViewSet):
+
+class OrderViewSet(PaginatedActionMixin, viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
@@ -333,40 +612,55 @@ class OrderViewSet(viewsets.ModelViewSet):
 
     # Create order from cart items    
     @action(detail=False, methods=['post'], permission_classes=[IsAuthenticated])
+    @idempotent
     def create_order(self, request):
         customer = request.user.customer
-        cart_items = Cart.objects.filter(customer=customer)
-
-        if not cart_items.exists():
-            return Response({"error": "Your cart is empty."}, status=status.HTTP_400_BAD_REQUEST)
-
-        order = Order.objects.create(customer=customer, discount=0.00)
-
-        for item in cart_items:
-            OrderItem.objects.create(
-                order=order,
-                book=item.book,
-                quantity=item.quantity,
-                price=item.book.price,
-                discount=item.book.discount,
-            )
-
-        order.total_price = order.calculate_total()
-        order.save()
-
-        if order.pk is not None:
-            order_data = {
-                'order_action': 'create',
-                'order_id': order.id,
-                'customer_id': customer.id,
-                'status': order.status,
-                'total_price': str(order.total_price),
-                'created_at': order.created_at.isoformat(),
-                'updated_at': order.updated_at.isoformat()
-            }
-            send_message('order_topic',json.dumps(order_data))
+        with get_cart_store().synced(customer.id):
+            return self.checkout(customer)
+
+    # The order is written in one transaction with a fixed number of queries: the cart, its books
+    # locked, the stock reservation, the order with its total computed in memory, all items at once
+    # and the cart removal. The cart rows are locked too, so a concurrent checkout of the same cart
+    # waits and then finds it empty instead of ordering it twice
+    def checkout(self, customer):
+        try:
+            with transaction.atomic():
+                cart_items = list(Cart.objects.select_for_update().filter(customer=customer).order_by('id'))
+
+                if not cart_items:
+                    return Response({"error": "Your cart is empty."}, status=status.HTTP_400_BAD_REQUEST)
+
+                books = reserve_stock({item.book_id: item.quantity for item in cart_items})
+
+                order = Order(customer=customer, discount=Decimal('0.00'))
+                order_items = [
+                    OrderItem(
+                        order=order,
+                        book=books[item.book_id],
+                        quantity=item.quantity,
+                        price=books[item.book_id].price,
+                        discount=books[item.book_id].discount,
+                    )
+                    for item in cart_items
+                ]
+                order.total_price = order.calculate_total(order_items)
+                order.save()
+                OrderItem.objects.bulk_create(order_items)
+
+                Cart.objects.filter(id__in=[item.id for item in cart_items]).delete()
 
-        cart_items.delete()
+                order_data = {
+                    'order_action': 'create',
+                    'order_id': order.id,
+                    'customer_id': customer.id,
+                    'status': order.status,
+                    'total_price': str(order.total_price),
+                    'created_at': order.created_at.isoformat(),
+                    'updated_at': order.updated_at.isoformat()
+                }
+                enqueue_event('order_topic', order_data, key=order.id)
+        except OutOfStock as error:
+            return Response({"error": "Not enough stock.", "books": error.shortages}, status=status.HTTP_409_CONFLICT)
 
         serializer = OrderSerializer(order)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -383,9 +677,9 @@ class OrderViewSet(viewsets.ModelViewSet):
 
         serializer = self.get_serializer(order, data=request.data, partial=True)
         if serializer.is_valid():
-            serializer.save()
+            with transaction.atomic():
+                serializer.save()
 
-            if order.pk is not None:
                 order_data = {
                     'order_action': 'update',
                     'order_id': order.id,
@@ -395,21 +689,41 @@ class OrderViewSet(viewsets.ModelViewSet):
                     'created_at': order.created_at.isoformat(),
                     'updated_at': order.updated_at.isoformat()
                 }
-                send_message('order_topic',json.dumps(order_data))
-
-            if order.status == 'delivered':
-                for item in order.items.all():
-                    item_data = {
-                        'book_id': item.book.id if item.book else None,
-                        'book_title': item.book.title if item.book else 'Unknown',
-                        'quantity': item.quantity,
-                        'price': str(item.price),
-                        'discount': str(item.discount),
-                        'total_price': str(item.get_total_price()),
-                        'purchase_date': datetime.now().isoformat()  
-                    }
-        
-                    send_message('order_items_topic', json.dumps(item_data))            
+                enqueue_event('order_topic', order_data, key=order.id)
+
+                if order.status == 'delivered':
+                    self.enqueue_delivered_items(order)
 
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    # Items of a delivered order go out as order_items_topic events of up to ORDER_ITEMS_EVENT_CHUNK_SIZE
+    # items, built from one query. All chunks are keyed by the order id, so they stay in order on one partition
+    @staticmethod
+    def enqueue_delivered_items(order):
+        items = [
+            {
+                'book_id': item.book_id,
+                'book_title': item.book.title if item.book else 'Unknown',
+                'quantity': item.quantity,
+                'price': str(item.price),
+                'discount': str(item.discount),
+                'total_price': str(item.get_total_price()),
+            }
+            for item in order.items.select_related('book').order_by('id')
+        ]
+        if not items:
+            return
+
+        chunk_size = settings.ORDER_ITEMS_EVENT_CHUNK_SIZE or len(items)
+        chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+        purchase_date = timezone.now().isoformat()
+
+        for index, chunk in enumerate(chunks):
+            enqueue_event('order_items_topic', {
+                'order_id': order.id,
+                'purchase_date': purchase_date,
+                'chunk': index,
+                'chunks': len(chunks),
+                'items': chunk,
+            }, key=order.id)
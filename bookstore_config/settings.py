@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 import os
+import tempfile
 from dotenv import load_dotenv
 from pathlib import Path
 from datetime import timedelta
@@ -31,7 +32,28 @@ DEBUG = True
 
 ALLOWED_HOSTS = []
 
-KAFKA_BROKER_URL = 'kafka:9092'
+KAFKA_BROKER_URL = os.environ.get('KAFKA_BROKER_URL', 'kafka:9092')
+# Client side batching of the producer (books_operator/kafka_producer.py)
+KAFKA_PRODUCER_LINGER_MS = int(os.environ.get('KAFKA_PRODUCER_LINGER_MS', 20))
+KAFKA_PRODUCER_BATCH_SIZE = int(os.environ.get('KAFKA_PRODUCER_BATCH_SIZE', 131072))
+KAFKA_PRODUCER_COMPRESSION = os.environ.get('KAFKA_PRODUCER_COMPRESSION', 'lz4')
+# Bounded local queue and what produce does when it is full: 'block', 'drop' or 'raise'
+KAFKA_PRODUCER_QUEUE_SIZE = int(os.environ.get('KAFKA_PRODUCER_QUEUE_SIZE', 100000))
+KAFKA_PRODUCER_BACKPRESSURE = os.environ.get('KAFKA_PRODUCER_BACKPRESSURE', 'block')
+KAFKA_PRODUCER_BLOCK_TIMEOUT = float(os.environ.get('KAFKA_PRODUCER_BLOCK_TIMEOUT', 5))
+# Transport of the events relayed from the outbox: 'kafka', 'memory' (tests) or 'file' (NDJSON at EVENT_TRANSPORT_PATH)
+EVENT_TRANSPORT = os.environ.get('EVENT_TRANSPORT', 'kafka')
+EVENT_TRANSPORT_PATH = os.environ.get('EVENT_TRANSPORT_PATH', str(BASE_DIR / 'events.ndjson'))
+# Event schemas per topic and version. Events are sent as JSON, a topic with a schema opts in to
+# versioned msgpack once its consumers decode it: EVENT_ENCODINGS=order_topic=msgpack,customer_topic=msgpack
+EVENT_SCHEMA_PATH = os.environ.get('EVENT_SCHEMA_PATH', str(BASE_DIR / 'books_operator' / 'event_schemas.json'))
+EVENT_DEFAULT_ENCODING = os.environ.get('EVENT_DEFAULT_ENCODING', 'json')
+EVENT_ENCODINGS = dict(item.split('=', 1) for item in os.environ.get('EVENT_ENCODINGS', '').split(',') if item)
+# Items per order_items_topic event of a delivered order, 0 sends all items in one event
+ORDER_ITEMS_EVENT_CHUNK_SIZE = int(os.environ.get('ORDER_ITEMS_EVENT_CHUNK_SIZE', 500))
+
+# Upper bounds of the price buckets in /books/filter/ facets, the last bucket is open-ended
+BOOK_PRICE_FACET_BUCKETS = [10, 25, 50, 100]
 
 # Application definition
 
@@ -42,6 +64,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework_simplejwt',
     'django_extensions',
@@ -55,6 +78,8 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',  
     ],
+    'DEFAULT_PAGINATION_CLASS': 'books_operator.pagination.IdCursorPagination',
+    'PAGE_SIZE': int(os.environ.get('API_PAGE_SIZE', 20)),
 }
 
 SIMPLE_JWT = {
@@ -109,6 +134,56 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# Catalog read responses are cached in the 'catalog' cache. Every process must see the catalog version
+# bumped by the others (management commands change books too), so the default is a file cache shared by
+# the processes of one host; point CATALOG_CACHE_BACKEND/CATALOG_CACHE_LOCATION at redis or memcached for several hosts
+CATALOG_CACHE_BACKEND = os.environ.get('CATALOG_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache')
+CART_CACHE_BACKEND = os.environ.get('CART_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+# Cached carts must never be culled before they are flushed, backends that cull once MAX_ENTRIES is reached get this limit
+CART_CACHE_MAX_ENTRIES = int(os.environ.get('CART_CACHE_MAX_ENTRIES', 10 ** 9))
+CULLING_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.filebased.FileBasedCache',
+    'django.core.cache.backends.db.DatabaseCache',
+)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': CATALOG_CACHE_BACKEND,
+        'LOCATION': os.environ.get('CATALOG_CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'bookstore_catalog')),
+    },
+    'carts': {
+        'BACKEND': CART_CACHE_BACKEND,
+        'LOCATION': os.environ.get('CART_CACHE_LOCATION', 'carts'),
+        'OPTIONS': {'MAX_ENTRIES': CART_CACHE_MAX_ENTRIES} if CART_CACHE_BACKEND in CULLING_CACHE_BACKENDS else {},
+    },
+}
+
+CATALOG_CACHE_ALIAS = 'catalog'
+CATALOG_CACHE_TIMEOUT = int(os.environ.get('CATALOG_CACHE_TIMEOUT', 300))
+# A process-local catalog cache keeps serving responses other processes have invalidated, it is refused unless allowed here
+CATALOG_CACHE_ALLOW_LOCAL = os.environ.get('CATALOG_CACHE_ALLOW_LOCAL', '') == '1'
+
+# 'database' writes cart changes straight to the Cart table, 'cache' keeps carts in the
+# CART_CACHE_ALIAS cache and writes them back later (books_operator/cart_store.py)
+CART_STORAGE = os.environ.get('CART_STORAGE', 'database')
+CART_CACHE_ALIAS = 'carts'
+# The cart cache must be shared by all processes (flush_cart_store runs in its own) and must not
+# evict, e.g. redis with maxmemory-policy noeviction. A process-local cache is refused unless allowed here
+CART_CACHE_ALLOW_LOCAL = os.environ.get('CART_CACHE_ALLOW_LOCAL', '') == '1'
+# Cart lines older than this are deleted by the sweep_abandoned_carts command
+CART_TTL_DAYS = int(os.environ.get('CART_TTL_DAYS', 30))
+# Stored responses of Idempotency-Key requests older than this are deleted by sweep_idempotency_keys
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', 24))
+# Sent outbox events are kept this long before relay_outbox prunes them
+OUTBOX_RETENTION_HOURS = int(os.environ.get('OUTBOX_RETENTION_HOURS', 24))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 